@@ -0,0 +1,162 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import openpyxl
+import pandas as pd
+from salary_calc import Company, JobTypeBook
+
+
+def make_price_book(file_path: str, n_styles: int, n_operations: int, seed: int = 0)->list:
+    """
+    生成单价本，格式与JobTypeBook相同：每个款号一个区域，区域之间隔一个空列
+    第1行: 款号 | ： | job_id
+    第2行: 工序号 | 工序 | 单价
+    第3行起: sid | name | price
+    :return: list of job ids
+    """
+    rand = random.Random(seed)
+    work_book = openpyxl.Workbook(write_only=True)
+    work_sheet = work_book.create_sheet(title="单价表")
+    list_job_id = [180000 + loop for loop in range(n_styles)]
+    rows = [[] for _ in range(n_operations + 2)]
+    for job_id in list_job_id:
+        rows[0] += ["款号", "：", job_id, None]
+        rows[1] += ["工序号", "工序", "单价", None]
+        for sid in range(1, n_operations + 1):
+            rows[sid + 1] += [sid, "工序%d" % sid, round(rand.uniform(0.05, 2.0), 2), None]
+    for row in rows:
+        work_sheet.append(row)
+    work_book.save(file_path)
+    return list_job_id
+
+
+def make_employee_file(file_path: str, name: str, eid: int, list_job_id: list, n_operations: int,
+                       n_rows: int, seed: int = 0):
+    """
+    生成一个员工文件，表格“员工产值明细”，最后一行为小计
+    """
+    rand = random.Random(seed)
+    work_book = openpyxl.Workbook(write_only=True)
+    work_sheet = work_book.create_sheet(title="员工产值明细")
+    work_sheet.append(["员工：", name, "工号：", eid])
+    work_sheet.append(["款号", "工序", "数量"])
+    total = 0
+    for _ in range(n_rows):
+        count = rand.randint(1, 200)
+        total += count
+        work_sheet.append([rand.choice(list_job_id), rand.randint(1, n_operations), count])
+    work_sheet.append(["小计", None, total])
+    work_book.save(file_path)
+
+
+def _git_commit()->str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(work_dir: str, n_employees: int, n_styles: int, n_operations: int, n_rows: int,
+                  workers: int = None, repeat: int = 1, seed: int = 0)->dict:
+    """
+    生成测试数据并分别计时每个阶段
+    :return: 结果字典，stages[stage] = 每次运行的秒数
+    """
+    # 1 generate workbooks
+    price_book = os.path.join(work_dir, "price_book.xlsx")
+    list_job_id = make_price_book(price_book, n_styles, n_operations, seed)
+    employee_dir = os.path.join(work_dir, "employees")
+    os.makedirs(employee_dir, exist_ok=True)
+    list_employee_file = []
+    for loop in range(n_employees):
+        file_path = os.path.join(employee_dir, "employee_%04d.xlsx" % loop)
+        make_employee_file(file_path, "员工%04d" % loop, loop, list_job_id, n_operations, n_rows, seed + loop)
+        list_employee_file.append(file_path)
+
+    # 2 time each stage
+    dict_stage = {"price_book_load": [], "employee_ingest": [], "salary_calc": [],
+                  "export_employee_salary_sheet": [], "export_job_type_output_sheet": [], "export_reports": []}
+    for _ in range(repeat):
+        company = Company()
+
+        start = time.perf_counter()
+        company.c_job_type_book = JobTypeBook(file_path=price_book)
+        dict_stage["price_book_load"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        dict_error = company.load_employees(list_employee_file, workers=workers)
+        dict_stage["employee_ingest"].append(time.perf_counter() - start)
+        if dict_error:
+            raise Exception("%d个员工文件加载失败" % len(dict_error))
+
+        start = time.perf_counter()
+        company.calc_salary_matrix()
+        dict_stage["salary_calc"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        company.export_employee_salary_sheet(os.path.join(work_dir, "员工工资总表.xlsx"), verbose=False)
+        dict_stage["export_employee_salary_sheet"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        company.export_job_type_output_sheet(os.path.join(work_dir, "每个款号总产量.xlsx"))
+        dict_stage["export_job_type_output_sheet"].append(time.perf_counter() - start)
+
+        # same employees without cached results, both reports through the shared pipeline
+        fresh_company = Company()
+        fresh_company.c_job_type_book = company.c_job_type_book
+        for employee in company.c_dict_employee.values():
+            fresh_company.set_employee(employee)
+        start = time.perf_counter()
+        fresh_company.export_reports(os.path.join(work_dir, "每个款号总产量_pipeline.xlsx"),
+                                     os.path.join(work_dir, "员工工资总表_pipeline.xlsx"))
+        dict_stage["export_reports"].append(time.perf_counter() - start)
+
+    return {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "params": {"employees": n_employees, "styles": n_styles, "operations": n_operations,
+                   "rows_per_employee": n_rows, "workers": workers, "repeat": repeat, "seed": seed},
+        "stages": {stage: {"min": min(list_sec), "runs": list_sec} for (stage, list_sec) in dict_stage.items()},
+    }
+
+
+def main(argv: list = None)->int:
+    parser = argparse.ArgumentParser(description="ghSalaryCalc benchmark")
+    parser.add_argument("--employees", type=int, default=400)
+    parser.add_argument("--styles", type=int, default=300)
+    parser.add_argument("--operations", type=int, default=20, help="每个款号的工序数")
+    parser.add_argument("--rows", type=int, default=500, help="每个员工的工作记录行数")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", default=None, help="测试数据目录，默认为临时目录")
+    parser.add_argument("--output", default=None, help="结果JSON文件，默认输出到stdout")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.ERROR)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = args.work_dir or tmp_dir
+        os.makedirs(work_dir, exist_ok=True)
+        result = run_benchmark(work_dir, args.employees, args.styles, args.operations, args.rows,
+                               workers=args.workers, repeat=args.repeat, seed=args.seed)
+
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
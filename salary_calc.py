@@ -2,13 +2,216 @@ import os
 import numpy as np
 from pandas import Series, DataFrame
 import pandas as pd
-import xlwings as xw
+import openpyxl
+import openpyxl.cell
+import openpyxl.styles
 import logging
-import tkinter as tk
-import tkinter.filedialog
-import tkinter.messagebox
-import traceback
+import hashlib
+import json
+import sqlite3
+import importlib.util
+import argparse
+import glob
+import sys
+import time
 import threading
+import typing
+import array
+import collections.abc
+import functools
+import queue
+import multiprocessing
+import concurrent.futures
+import cProfile
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, CancelledError
+if typing.TYPE_CHECKING:
+    import xlwings as xw
+
+JOB_TYPE_OUTPUT_FILE = "每个款号总产量.xlsx"
+EMPLOYEE_SALARY_FILE = "员工工资总表.xlsx"
+EXPORT_FORMATS = ("xlsx", "csv", "parquet", "feather")
+
+
+class Instrumentation:
+    """
+    Per-stage timing, counters and memory of the hot paths
+    Attr:
+        i_stages: dict[stage name(str): dict[counter name(str): value]], counters are
+                  calls, wall_time(s), peak_memory(bytes, only when trace_memory is on) and
+                  whatever the stage counts, e.g. rows, price_lookups, duplicate_merges
+        i_trace_memory: measure peak memory of each stage with tracemalloc, makes the stages slower
+        i_profile: cProfile.Profile when profiling is on, only the thread calling enable is profiled
+    """
+    def __init__(self):
+        self.i_stages: dict = {}
+        self.i_trace_memory: bool = False
+        self.i_profile: cProfile.Profile = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enable(self, trace_memory: bool = False, profile: bool = False):
+        self.i_trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if profile:
+            self.i_profile = cProfile.Profile()
+            self.i_profile.enable()
+
+    def reset(self):
+        with self._lock:
+            self.i_stages = {}
+
+    def stage(self, name: str):
+        """
+        decorator, record one call of the function as stage name
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                stack = self._stack()
+                frame = {"counters": {}, "peak_memory": 0}
+                if self.i_trace_memory:
+                    # keep the peak the outer stage has reached so far, reset_peak discards it
+                    if stack:
+                        stack[-1]["peak_memory"] = max(stack[-1]["peak_memory"], tracemalloc.get_traced_memory()[1])
+                    tracemalloc.reset_peak()
+                stack.append(frame)
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    wall_time = time.perf_counter() - start
+                    stack.pop()
+                    if self.i_trace_memory:
+                        frame["peak_memory"] = max(frame["peak_memory"], tracemalloc.get_traced_memory()[1])
+                        if stack:
+                            stack[-1]["peak_memory"] = max(stack[-1]["peak_memory"], frame["peak_memory"])
+                    self._record(name, wall_time, frame)
+            return wrapper
+        return decorator
+
+    def record(self, name: str, wall_time: float, **counters):
+        """
+        记录一次在别处计时的调用，例如在子进程中运行、统计无法直接带回的阶段
+        """
+        self._record(name, wall_time, {"counters": counters, "peak_memory": 0})
+
+    def count(self, counter: str, n: int = 1):
+        """
+        add n to a counter of the innermost running stage of this thread
+        """
+        stack = self._stack()
+        if stack:
+            stack[-1]["counters"][counter] = stack[-1]["counters"].get(counter, 0) + n
+
+    def _stack(self)->list:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _record(self, name: str, wall_time: float, frame: dict):
+        with self._lock:
+            stats = self.i_stages.setdefault(name, {"calls": 0, "wall_time": 0.0})
+            stats["calls"] += 1
+            stats["wall_time"] += wall_time
+            for (counter, n) in frame["counters"].items():
+                stats[counter] = stats.get(counter, 0) + n
+            if self.i_trace_memory:
+                stats["peak_memory"] = max(stats.get("peak_memory", 0), frame["peak_memory"])
+
+    def report(self)->dict:
+        with self._lock:
+            return {"stages": {name: dict(stats) for (name, stats) in self.i_stages.items()}}
+
+    def to_json(self)->str:
+        return json.dumps(self.report(), indent=2, ensure_ascii=False)
+
+    def summary(self)->str:
+        """
+        一行文字的摘要，用于界面状态栏
+        """
+        return " ".join("%s:%.2fs" % (name, stats["wall_time"]) for (name, stats) in self.report()["stages"].items())
+
+    def log_report(self):
+        logging.info("instrumentation %s\n" % self.to_json())
+
+    def dump_profile(self, file_path: str):
+        """
+        停止cProfile并保存结果，可以用pstats或snakeviz查看
+        """
+        if self.i_profile is not None:
+            self.i_profile.disable()
+            self.i_profile.dump_stats(file_path)
+            self.i_profile = None
+
+
+instrumentation = Instrumentation()
+
+
+def _read_sheet_values(file_path: str, sheet_name: str)->list:
+    """
+    不经过Excel，一次性读取整张表格的内容
+    :param file_path: xls或xlsx文件
+    :param sheet_name: 表格名
+    :return: list of rows, 空单元格为None
+    """
+    _file_ext = os.path.splitext(file_path)[1]
+    if _file_ext == ".xlsx":
+        work_book = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            if sheet_name not in work_book.sheetnames:
+                raise Exception("文件%s里不包含表格‘%s’" % (file_path, sheet_name))
+            return [list(row) for row in work_book[sheet_name].iter_rows(values_only=True)]
+        finally:
+            work_book.close()
+    elif _file_ext == ".xls":
+        dict_df = pd.read_excel(file_path, sheet_name=None, header=None)
+        if sheet_name not in dict_df:
+            raise Exception("文件%s里不包含表格‘%s’" % (file_path, sheet_name))
+        df = dict_df[sheet_name]
+        return df.astype(object).where(df.notna(), None).values.tolist()
+    else:
+        raise Exception("不支持的文件格式: %s" % _file_ext)
+
+
+def _iter_sheet_rows(file_path: str, sheet_name: str = None, min_row: int = 1, min_col: int = 1,
+                     max_col: int = None):
+    """
+    逐行读取表格，xlsx文件用openpyxl的read-only模式，内存占用不随行数增长
+    :param file_path: xls或xlsx文件
+    :param sheet_name: 表格名，None表示第一个表格
+    :param min_row: 从这一行开始读，从1开始
+    :param min_col: 只读min_col到max_col列，从1开始，max_col为None表示到最后一列
+    :return: generator of row tuples, 空单元格为None, row[0]是第min_col列
+    """
+    _file_ext = os.path.splitext(file_path)[1]
+    if _file_ext == ".xlsx":
+        work_book = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            if sheet_name is not None and sheet_name not in work_book.sheetnames:
+                raise Exception("文件%s里不包含表格‘%s’" % (file_path, sheet_name))
+            work_sheet = work_book[sheet_name] if sheet_name is not None else work_book.worksheets[0]
+            yield from work_sheet.iter_rows(min_row=min_row, min_col=min_col, max_col=max_col, values_only=True)
+        finally:
+            work_book.close()
+    elif _file_ext == ".xls":
+        # xlrd can not stream, the whole sheet is read at once
+        df = pd.read_excel(file_path, sheet_name=sheet_name if sheet_name is not None else 0, header=None)
+        df = df.iloc[min_row - 1:, min_col - 1:max_col]
+        for row in df.astype(object).where(df.notna(), None).itertuples(index=False, name=None):
+            yield row
+    else:
+        raise Exception("不支持的文件格式: %s" % _file_ext)
+
+
+def _cell(values: list, row: int, col: int):
+    """
+    按Excel的行列号（从1开始）读取二维数组，超出范围视为空单元格
+    """
+    if row > len(values) or col > len(values[row - 1]):
+        return None
+    return values[row - 1][col - 1]
 
 
 class JobSubType:
@@ -19,6 +222,7 @@ class JobSubType:
         s_name: sub type name
         s_price: sub type's price
     """
+    __slots__ = ("s_id", "s_name", "s_price")
     s_id: int
     s_name: str
     s_price: float
@@ -39,79 +243,341 @@ class JobType:
     Attr:
         j_id: job id
         j_dict_sub_types: dict[s_id(int): JobSubType]
+        j_dict_name_to_sid: dict[s_name(str): s_id(int)], first sub type wins for duplicated names
     """
     def __init__(self, jid: int):
         self.j_id: int = jid
         self.j_dict_sub_types: dict[int:JobSubType] = {}
+        self.j_dict_name_to_sid: dict[str:int] = {}
 
     def add_sub_type(self, sid: int, name: str, price: float):
         sub_type = JobSubType(sid, name, price)
         self.j_dict_sub_types[sid] = sub_type
+        self.j_dict_name_to_sid.setdefault(name, sid)
 
     def _get_sub_type_by_id(self, sid: int)->JobSubType:
         return self.j_dict_sub_types[sid]
 
     def _get_sub_type_by_name(self, name: str)->JobSubType:
-        for sub_type in self.j_dict_sub_types.values():
-            if sub_type.s_name == name:
-                return sub_type
+        if name in self.j_dict_name_to_sid:
+            return self.j_dict_sub_types[self.j_dict_name_to_sid[name]]
         logging.error("Can't find sub type id %s\n", name)
         raise Exception("工序号‘%s’无效" % name)
 
 
+def _split_regions(values: list)->list:
+    """
+    “单价表”每个款号一个区域，区域之间隔空列，只需要第1行
+    :param values: list of rows, 至少包含第1行
+    :return: 每个区域的起始列，从1开始
+    """
+    list_region_start_cols = []
+    continue_blank_line_cnt = 1
+    ncols = 1
+    while continue_blank_line_cnt < 3:
+        if _cell(values, 1, ncols) is None:
+            continue_blank_line_cnt += 1
+        else:
+            if continue_blank_line_cnt != 0:
+                list_region_start_cols.append(ncols)
+            continue_blank_line_cnt = 0
+        ncols += 1
+    return list_region_start_cols
+
+
+class LazyJobTypes(collections.abc.MutableMapping):
+    """
+    Job types of a price book file, dict[j_id(int): JobType], read only when first used
+    Attr:
+        l_file_path: price book file
+        l_dict_start_col: all job types of the file, dict[j_id(int): start col of its region], None if added later
+        l_loaded: job types already read, dict[j_id(int): JobType]
+        l_on_load: called after new job types are read, however they were asked for, None for nothing
+    Only the first row is read up front. load reads the sub types of many job types in one streaming
+    pass, which stops as soon as the longest of those regions ends.
+    """
+    def __init__(self, file_path: str, on_load=None):
+        self.l_file_path = file_path
+        self.l_dict_start_col: dict[int:int] = {}
+        self.l_loaded: dict[int:JobType] = {}
+        self.l_on_load = on_load
+        self._lock = threading.Lock()
+        rows = _iter_sheet_rows(file_path, "单价表")
+        try:
+            values = [list(next(rows, ()))]
+        finally:
+            rows.close()
+        for start_col in _split_regions(values):
+            self.l_dict_start_col[int(_cell(values, 1, start_col + 2))] = start_col
+
+    def load(self, job_ids)->bool:
+        """
+        读取还没有读取的款号
+        :param job_ids: 款号，不在单价本中的忽略
+        :return: 是否读取了新的款号
+        """
+        with self._lock:
+            dict_start_col = {jid: self.l_dict_start_col[jid] for jid in job_ids
+                              if jid not in self.l_loaded and self.l_dict_start_col.get(jid) is not None}
+            if not dict_start_col:
+                return False
+            min_col = min(dict_start_col.values())
+            max_col = max(dict_start_col.values()) + 2
+            dict_job_type = {jid: JobType(jid) for jid in dict_start_col}
+            rows = _iter_sheet_rows(self.l_file_path, "单价表", min_row=3, min_col=min_col, max_col=max_col)
+            try:
+                for row in rows:
+                    for (jid, start_col) in list(dict_start_col.items()):
+                        col = start_col - min_col
+                        cells = (tuple(row[col:col + 3]) + (None, ) * 3)[:3]
+                        if cells[1] is None:
+                            del dict_start_col[jid]
+                            continue
+                        dict_job_type[jid].add_sub_type(sid=int(cells[0]), name=cells[1], price=cells[2])
+                        instrumentation.count("rows")
+                    if not dict_start_col:
+                        break
+            finally:
+                rows.close()
+            self.l_loaded.update(dict_job_type)
+        if self.l_on_load is not None:
+            self.l_on_load()
+        return True
+
+    def __getitem__(self, jid: int)->JobType:
+        if jid not in self.l_loaded:
+            if jid not in self.l_dict_start_col:
+                raise KeyError(jid)
+            self.load([jid])
+        return self.l_loaded[jid]
+
+    def __setitem__(self, jid: int, job_type: JobType):
+        self.l_dict_start_col.setdefault(jid, None)
+        self.l_loaded[jid] = job_type
+
+    def __delitem__(self, jid: int):
+        del self.l_dict_start_col[jid]
+        self.l_loaded.pop(jid, None)
+
+    def __contains__(self, jid)->bool:
+        return jid in self.l_dict_start_col
+
+    def __iter__(self):
+        return iter(self.l_dict_start_col)
+
+    def __len__(self)->int:
+        return len(self.l_dict_start_col)
+
+    def values(self):
+        self.load(self.l_dict_start_col)
+        return super().values()
+
+    def items(self):
+        self.load(self.l_dict_start_col)
+        return super().items()
+
+
+def _is_price(price)->bool:
+    """
+    单价是否为数字，空单元格、文字和NaN都不是
+    """
+    return isinstance(price, (int, float, np.integer, np.floating)) and not isinstance(price, bool) \
+        and not np.isnan(price)
+
+
 class JobTypeBook:
     """
     A job type book, collect all job types
     Attr:
-        b_dict_job_types: dict[j_id(int): JobType]
+        b_dict_job_types: dict[j_id(int): JobType], LazyJobTypes when loaded lazily
+        b_job_row: dict[j_id(int): row of b_price_matrix]
+        b_sub_col: dict[s_id(int): col of b_price_matrix]
+        b_price_matrix: read only 2-D price array, job type x sub type, NaN for no price
+        b_price_mask: read only 2-D bool array, True where the job type has the sub type and its price is a number
+        b_version: increased every time a price changes
+    The price index is built once after loading and rebuilt only when add_job_type is called
+    or a lazy book reads more job types, so JobType objects should not be changed after they
+    are added to the book. All job types have a row in b_price_matrix, rows of job types not
+    read yet are NaN until they are queried.
     """
-    def __init__(self, sht: xw.main.Sheet):
+    @instrumentation.stage("job_type_book")
+    def __init__(self, sht: "xw.main.Sheet" = None, file_path: str = None, cache: "ParseCache" = None,
+                 lazy: bool = False):
+        """
+        :param sht: 已打开的“单价表”，整张表只读取一次
+        :param file_path: 单价本文件路径，不经过Excel直接读取
+        :param cache: 读取file_path时使用的缓存，文件未修改时不再解析
+        :param lazy: 只读取第1行，款号第一次被查询时才读取它的工序，只支持xlsx，lazy时不写入缓存
+        """
         self.b_dict_job_types: dict[int:JobType] = {}
-        list_region_start_cols = []
-        # 1 split sheet into regions, get region start col
-        continue_blank_line_cnt = 1
-        ncols = 1
-        while continue_blank_line_cnt < 3:
-            if sht.range((1, ncols)).value is None:
-                continue_blank_line_cnt += 1
+        self.b_job_row: dict[int:int] = {}
+        self.b_sub_col: dict[int:int] = {}
+        self.b_price_matrix: np.ndarray = None
+        self.b_price_mask: np.ndarray = None
+        self.b_version: int = 0
+        self._job_index: pd.Index = None
+        self._sub_index: pd.Index = None
+        self._price_table: DataFrame = None
+        self._data_frame: DataFrame = None
+        if sht is not None:
+            values = sht.range((1, 1), sht.used_range.last_cell).options(ndim=2).value
+            self.load_from_values(values)
+        elif file_path is not None:
+            cached_book = cache.load_job_type_book(file_path) if cache is not None else None
+            if cached_book is not None:
+                self.b_dict_job_types = cached_book.b_dict_job_types
+                self._build_index()
+            elif lazy and os.path.splitext(file_path)[1] == ".xlsx":
+                self.b_dict_job_types = LazyJobTypes(file_path, on_load=functools.partial(self._build_index, False))
+                self._build_index()
             else:
-                if continue_blank_line_cnt != 0:
-                    list_region_start_cols.append(ncols)
-                continue_blank_line_cnt = 0
-            ncols += 1
+                self.load_from_values(_read_sheet_values(file_path, "单价表"))
+                if cache is not None:
+                    cache.save_job_type_book(file_path, self)
+        else:
+            self._build_index()
+
+    def _build_index(self, new_version: bool = True):
+        """
+        建立价格索引：款号/工序号到矩阵行列的映射和稠密的价格矩阵
+        :param new_version: 价格没有变化（lazy读取了更多款号）时为False，已算好的工资继续有效
+        """
+        if isinstance(self.b_dict_job_types, LazyJobTypes):
+            dict_loaded = self.b_dict_job_types.l_loaded
+        else:
+            dict_loaded = self.b_dict_job_types
+        self.b_job_row = {jid: row for (row, jid) in enumerate(self.b_dict_job_types.keys())}
+        self.b_sub_col = {}
+        for job_type in dict_loaded.values():
+            for sid in job_type.j_dict_sub_types.keys():
+                self.b_sub_col.setdefault(sid, len(self.b_sub_col))
+        self.b_price_matrix = np.full((len(self.b_job_row), len(self.b_sub_col)), np.nan)
+        self.b_price_mask = np.zeros(self.b_price_matrix.shape, dtype=bool)
+        for job_type in dict_loaded.values():
+            row = self.b_job_row[job_type.j_id]
+            for sub_type in job_type.j_dict_sub_types.values():
+                col = self.b_sub_col[sub_type.s_id]
+                # a blank or non-numeric price stays NaN and invalid, so queries raise as for an unknown sub type
+                if _is_price(sub_type.s_price):
+                    self.b_price_matrix[row, col] = sub_type.s_price
+                    self.b_price_mask[row, col] = True
+        self.b_price_matrix.flags.writeable = False
+        self.b_price_mask.flags.writeable = False
+        self._job_index = pd.Index(list(self.b_job_row.keys()))
+        self._sub_index = pd.Index(list(self.b_sub_col.keys()))
+        self._price_table = None
+        self._data_frame = None
+        if new_version:
+            self.b_version += 1
+
+    def _load_job_types(self, job_ids):
+        """
+        lazy时读取这些款号的工序，价格索引由LazyJobTypes.l_on_load更新，其他情况什么都不做
+        """
+        if isinstance(self.b_dict_job_types, LazyJobTypes):
+            self.b_dict_job_types.load(job_ids)
 
-        ncols -= 4
+    def load_from_values(self, values: list):
+        """
+        从“单价表”的二维数组加载所有货品，数组下标从0开始，对应表格的第1行第1列
+        :param values: list of rows
+        :return:
+        """
+        # 1 split sheet into regions, get region start col
+        list_region_start_cols = _split_regions(values)
 
         # 2 get region nrows
         for start_col in list_region_start_cols:
-            job_type = JobType(int(sht.range((1, start_col + 2)).value))
+            job_type = JobType(int(_cell(values, 1, start_col + 2)))
             raw_loop = 3
-            while sht.range((raw_loop, start_col + 1)).value is not None:
-                job_type.add_sub_type(sid=int(sht.range((raw_loop, start_col)).value),
-                                      name=sht.range((raw_loop, start_col + 1)).value,
-                                      price=sht.range((raw_loop, start_col + 2)).value)
+            while _cell(values, raw_loop, start_col + 1) is not None:
+                job_type.add_sub_type(sid=int(_cell(values, raw_loop, start_col)),
+                                      name=_cell(values, raw_loop, start_col + 1),
+                                      price=_cell(values, raw_loop, start_col + 2))
                 raw_loop += 1
-            self.add_job_type(job_type)
+            self.b_dict_job_types[job_type.j_id] = job_type
+            instrumentation.count("rows", raw_loop - 3)
+        self._build_index()
 
     def _get_job_type(self, jid: int)->JobType:
         return self.b_dict_job_types[jid]
 
     def add_job_type(self, job_type: JobType):
         self.b_dict_job_types[job_type.j_id] = job_type
+        self._build_index()
+
+    def set_price(self, job_id: int, sub_id: int, price: float):
+        """
+        修改一个已有工序的单价，只更新价格矩阵中的一个元素
+        """
+        self._load_job_types([job_id])
+        row = self.b_job_row.get(job_id)
+        col = self.b_sub_col.get(sub_id)
+        if row is None or col is None or sub_id not in self._get_job_type(job_id).j_dict_sub_types:
+            logging.error("set_price: Invalid job id %d or sub id %d\n" % (job_id, sub_id))
+            raise Exception("所要求的货品ID无效（%d-%d）\n" % (job_id, sub_id))
+        self._get_job_type(job_id)._get_sub_type_by_id(sub_id).s_price = price
+        matrix = self.b_price_matrix.copy()
+        matrix[row, col] = price if _is_price(price) else np.nan
+        matrix.flags.writeable = False
+        self.b_price_matrix = matrix
+        if self.b_price_mask[row, col] != _is_price(price):
+            mask = self.b_price_mask.copy()
+            mask[row, col] = _is_price(price)
+            mask.flags.writeable = False
+            self.b_price_mask = mask
+        self._price_table = None
+        self._data_frame = None
+        self.b_version += 1
 
     def query_price_by_id(self, job_id: int, sub_id: int)->float:
-        if job_id not in self.b_dict_job_types \
-                or sub_id not in self.b_dict_job_types[job_id].j_dict_sub_types:
+        self._load_job_types([job_id])
+        row = self.b_job_row.get(job_id)
+        col = self.b_sub_col.get(sub_id)
+        instrumentation.count("price_lookups")
+        if row is None or col is None or not self.b_price_mask[row, col]:
             logging.error("query_price_by_id: Invalid job id %d or sub id %d\n"
                           % (job_id, sub_id))
             raise Exception("所要求的货品ID无效（%d-%d）\n"
                             % (job_id, sub_id))
 
-        return self._get_job_type(job_id)._get_sub_type_by_id(sub_id).s_price
+        return self.b_price_matrix[row, col]
+
+    def query_prices(self, job_ids: np.ndarray, sub_ids: np.ndarray)->tuple:
+        """
+        批量查询单价
+        :param job_ids: 款号数组
+        :param sub_ids: 工序号数组，与job_ids一一对应
+        :return: (prices, valid), valid为False的位置单价无效
+        """
+        instrumentation.count("price_lookups", len(job_ids))
+        self._load_job_types(pd.unique(np.asarray(job_ids)).tolist())
+        rows = self._job_index.get_indexer(job_ids)
+        cols = self._sub_index.get_indexer(sub_ids)
+        valid = (rows >= 0) & (cols >= 0)
+        valid[valid] = self.b_price_mask[rows[valid], cols[valid]]
+        prices = np.full(len(valid), np.nan)
+        prices[valid] = self.b_price_matrix[rows[valid], cols[valid]]
+        return prices, valid
 
     def query_price_by_name(self, job_id: int, sub_type_name: str)->float:
         return self._get_job_type(job_id)._get_sub_type_by_name(sub_type_name).s_price
 
+    def get_price_table(self)->DataFrame:
+        """
+        获取长表形式的单价本，每行一个工序
+          | job_type_id | sub_type_id | price
+        0 | 180072      | 1           | 0.5
+        :return: DataFrame, 只读，不要修改
+        """
+        self._load_job_types(self.b_dict_job_types.keys())
+        if self._price_table is None:
+            records = [(job_type.j_id, sub_type.s_id, sub_type.s_price)
+                       for job_type in self.b_dict_job_types.values()
+                       for sub_type in job_type.j_dict_sub_types.values()]
+            self._price_table = DataFrame(records, columns=["job_type_id", "sub_type_id", "price"])
+        return self._price_table
+
     def get_dict(self)->dict:
         """
         获取一个字典，key是所有可能的sub type id，值是每个job type对应的sub type id的单价，如下图
@@ -120,20 +586,21 @@ class JobTypeBook:
         job 1 | price10 | price 11 | price 12 |...
         job 2 | price20 | price 21 | price 22 |..
 
+        job type没有的sub type，单价为NaN
         :return: 字典
         """
-        dict_book = {}
-        for job_type in self.b_dict_job_types.values():
-            for sub_type in job_type.j_dict_sub_types.values():
-                if sub_type in dict_book:
-                    dict_book[sub_type.s_id].append(sub_type.s_price)
-                else:
-                    dict_book[sub_type.s_id] = [sub_type.s_price]
-        return dict_book
+        self._load_job_types(self.b_dict_job_types.keys())
+        return {sid: self.b_price_matrix[:, col].tolist() for (sid, col) in self.b_sub_col.items()}
 
     def get_data_frame(self)->DataFrame:
-        return DataFrame(self.get_dict(),
-                         index=[job_type.j_id for job_type in self.b_dict_job_types.values()])
+        """
+        :return: 与get_dict相同的表格，index为款号，columns为工序号，只读，不要修改
+        """
+        self._load_job_types(self.b_dict_job_types.keys())
+        if self._data_frame is None:
+            self._data_frame = DataFrame(self.b_price_matrix, index=list(self.b_job_row.keys()),
+                                         columns=list(self.b_sub_col.keys()))
+        return self._data_frame
 
 
 class Job:
@@ -144,52 +611,851 @@ class Job:
         sub_type_id: sub job type id
         finish_count: quantities of finished jobs
     """
+    __slots__ = ("job_type_id", "sub_type_id", "finish_count")
+
     def __init__(self, job_type_id: int = 0, sub_type_id: int = 0, finish_count: int = 0):
         self.job_type_id = job_type_id
         self.sub_type_id = sub_type_id
         self.finish_count = finish_count
 
 
+JOB_COLUMNS = ["job_type_id", "sub_type_id", "finish_count"]
+
+
+JOB_CHUNK_ROWS = 10000
+
+
+def _int_cell(cell)->int:
+    """
+    整数单元格的值，Excel保存的12.0和文字"12"也可以
+    :raise: TypeError, ValueError, 单元格为空、True/False或者不是整数(12.7)时
+    """
+    if isinstance(cell, bool):
+        raise ValueError("%r不是整数" % cell)
+    if isinstance(cell, int):
+        return cell
+    value = float(cell)
+    if not value.is_integer():
+        raise ValueError("%r不是整数" % cell)
+    return int(value)
+
+
+def _iter_job_chunks(rows, file_path: str, first_row: int = 3, chunk_rows: int = JOB_CHUNK_ROWS):
+    """
+    把“员工产值明细”的工作记录分块解析，跳过空行和“小计”行
+    :param rows: 逐行的迭代器，第一行是表格的first_row行
+    :param file_path: 用于错误信息
+    :return: generator of DataFrame[job_type_id, sub_type_id, finish_count], 每块最多chunk_rows行
+    """
+    list_values = (array.array("q"), array.array("q"), array.array("q"))
+    for (row_loop, row) in enumerate(rows, start=first_row):
+        cells = (tuple(row[:3]) + (None, ) * 3)[:3]
+        if type(cells[0]) is not int or type(cells[1]) is not int or type(cells[2]) is not int:
+            if all(cell is None for cell in cells) \
+                    or any(isinstance(cell, str) and "小计" in cell for cell in cells):
+                continue
+            try:
+                cells = tuple(_int_cell(cell) for cell in cells)
+            except (TypeError, ValueError):
+                raise Exception("员工文件%s第%d行格式不正确" % (file_path, row_loop))
+        for (values, cell) in zip(list_values, cells):
+            values.append(cell)
+        if len(list_values[0]) >= chunk_rows:
+            yield DataFrame({column: np.frombuffer(values, dtype=np.int64)
+                             for (column, values) in zip(JOB_COLUMNS, list_values)})
+            list_values = (array.array("q"), array.array("q"), array.array("q"))
+    yield DataFrame({column: np.frombuffer(values, dtype=np.int64)
+                     for (column, values) in zip(JOB_COLUMNS, list_values)})
+
+
+@instrumentation.stage("load_jobs_from_file")
+def _read_employee_file(file_path: str)->tuple:
+    """
+    不经过Excel读取一个员工文件，文件只打开一次，逐块读取并合并，内存占用不随行数增长
+    :param file_path: xls或xlsx文件
+    :return: (name, eid, DataFrame[job_type_id, sub_type_id, finish_count], duplicates),
+             工作记录已合并，duplicates为合并掉的重复记录，见Employee.e_duplicates
+    """
+    rows = _iter_sheet_rows(file_path, "员工产值明细")
+    try:
+        first_line = (tuple(next(rows, ())) + (None, ) * 4)[:4]
+        if first_line[0] != "员工：" or first_line[2] != "工号：":
+            raise Exception("表格%s格式不正确" % file_path)
+        next(rows, None)
+        employee = Employee(first_line[1], first_line[3])
+        for df_chunk in _iter_job_chunks(rows, file_path):
+            employee.add_jobs(df_chunk)
+    finally:
+        rows.close()
+    return employee.e_name, employee.e_id, employee.e_jobs, employee.e_duplicates
+
+
+def _parse_employee_file(file_path: str)->tuple:
+    """
+    在进程池中读取一个员工文件，子进程里记录的统计会丢失，所以把用时带回主进程
+    :return: (_read_employee_file的结果, 用时(s))
+    """
+    start = time.perf_counter()
+    result = _read_employee_file(file_path)
+    return result, time.perf_counter() - start
+
+
+CONSOLIDATED_NAME_HEADERS = ("员工", "姓名", "员工姓名")
+CONSOLIDATED_ID_HEADERS = ("工号", "员工编号")
+
+
+def _read_consolidated_file(file_path: str, sheet_name: str = None)->list:
+    """
+    读取包含多个员工的汇总表，一次流式读取，按员工分组
+    表头在前10行内，包含“款号”“工序”“数量”和员工姓名或工号列：
+    员工 | 工号 | 款号 | 工序 | 数量
+    跳过空行和“小计”行，只有工号列时用工号（字符串）作为员工姓名
+    :param file_path: xls或xlsx文件
+    :param sheet_name: 表格名，None表示第一个表格
+    :return: list of (name, eid, DataFrame[job_type_id, sub_type_id, finish_count]), 按第一次出现的顺序
+    """
+    rows = _iter_sheet_rows(file_path, sheet_name)
+    # 1 find header
+    dict_col = None
+    for (row_loop, row) in enumerate(rows, start=1):
+        header = [str(cell).strip().rstrip("：:") if cell is not None else None for cell in row]
+        if all(name in header for name in ("款号", "工序", "数量")):
+            dict_col = {name: header.index(name) for name in ("款号", "工序", "数量")}
+            dict_col["name"] = next((header.index(name) for name in CONSOLIDATED_NAME_HEADERS if name in header), None)
+            dict_col["eid"] = next((header.index(name) for name in CONSOLIDATED_ID_HEADERS if name in header), None)
+            if dict_col["name"] is not None or dict_col["eid"] is not None:
+                break
+        dict_col = None
+        if row_loop >= 10:
+            break
+    if dict_col is None:
+        rows.close()
+        raise Exception("汇总表%s格式不正确：找不到员工、款号、工序、数量列" % file_path)
+
+    # 2 stream rows into per employee int64 columns
+    col_job, col_sub, col_count = dict_col["款号"], dict_col["工序"], dict_col["数量"]
+    col_name, col_eid = dict_col["name"], dict_col["eid"]
+    ncols = max(col for col in dict_col.values() if col is not None) + 1
+    dict_employee = {}
+    for (row_loop, row) in enumerate(rows, start=row_loop + 1):
+        if len(row) < ncols:
+            row = tuple(row) + (None, ) * (ncols - len(row))
+        eid = row[col_eid] if col_eid is not None else None
+        name = row[col_name] if col_name is not None else eid
+        # employees are keyed by name, so a sheet with only 工号 uses it as the name
+        if name is not None and not isinstance(name, str):
+            name = str(int(name)) if isinstance(name, float) and name.is_integer() else str(name)
+        job = (row[col_job], row[col_sub], row[col_count])
+        # slow path only for rows which are not three integers
+        if type(job[0]) is not int or type(job[1]) is not int or type(job[2]) is not int \
+                or name is None or (isinstance(name, str) and "小计" in name):
+            if all(cell is None for cell in row) \
+                    or any(isinstance(cell, str) and "小计" in cell for cell in row):
+                continue
+            try:
+                job = tuple(_int_cell(cell) for cell in job)
+            except (TypeError, ValueError):
+                raise Exception("汇总表%s第%d行格式不正确" % (file_path, row_loop))
+            if name is None:
+                raise Exception("汇总表%s第%d行格式不正确" % (file_path, row_loop))
+        columns = dict_employee.get(name)
+        if columns is None:
+            columns = dict_employee[name] = (eid, array.array("q"), array.array("q"), array.array("q"))
+        elif eid != columns[0]:
+            logging.warning("汇总表%s第%d行：员工%s的工号不一致" % (file_path, row_loop, name))
+        columns[1].append(job[0])
+        columns[2].append(job[1])
+        columns[3].append(job[2])
+
+    return [(name, eid, DataFrame({column: np.frombuffer(values, dtype=np.int64)
+                                   for (column, values) in zip(JOB_COLUMNS, list_values)}))
+            for (name, (eid, *list_values)) in dict_employee.items()]
+
+
+VALIDATION_UNKNOWN_JOB_TYPE = "款号不在单价本中，不计工资"
+VALIDATION_UNKNOWN_SUB_TYPE = "工序不在单价本中"
+VALIDATION_NO_PRICE = "单价为空或不是数字"
+VALIDATION_NON_POSITIVE_COUNT = "数量不是正数"
+VALIDATION_DUPLICATE = "重复记录，已合并"
+# only records which make the salary sheet impossible block the export, corrections
+# with zero or negative counts are exported as before and only reported
+VALIDATION_ERRORS = (VALIDATION_UNKNOWN_SUB_TYPE, VALIDATION_NO_PRICE)
+
+
 class Employee:
     """
     A Employee
     Attr:
         e_name: employee name
         e_id: employee id
-        e_do_jobs: jobs employee had finished, list = [Job]
-        e_do_jobs_dict: jobs employeee had finished, dict[j_id(int): dict[s_id(int): finish_count(int)]]
+        e_jobs: jobs employee had finished, DataFrame[job_type_id, sub_type_id, finish_count],
+                one row per (job_type_id, sub_type_id)
+        e_do_jobs: read only view of e_jobs, list = [Job]
+        e_do_jobs_dict: read only view of e_jobs, dict[j_id(int): dict[s_id(int): finish_count(int)]]
+        e_version: increased every time jobs are added
+        e_duplicates: records merged into e_jobs because their (job_type_id, sub_type_id) was already there,
+                      DataFrame[job_type_id, sub_type_id, finish_count]
+        e_file_path: file the jobs were loaded from, None if unknown
     """
     def __init__(self, name: str, eid: int, file_path: str = None):
         self.e_name = name
         self.e_id = eid
-        self.e_do_jobs: list = []
-        self.e_do_jobs_dict: dict = {}
+        self.e_jobs: DataFrame = DataFrame(columns=JOB_COLUMNS, dtype=np.int64)
+        self.e_duplicates: DataFrame = DataFrame(columns=JOB_COLUMNS, dtype=np.int64)
+        self.e_file_path: str = file_path
+        self.e_version: int = 0
+        self._do_jobs: list = None
+        self._do_jobs_dict: dict = None
         if file_path is not None:
             self.load_jobs_from_file(file_path)
 
+    @property
+    def e_do_jobs(self)->list:
+        if self._do_jobs is None:
+            self._do_jobs = [Job(job_type_id, sub_type_id, finish_count)
+                             for (job_type_id, sub_type_id, finish_count)
+                             in self.e_jobs[JOB_COLUMNS].itertuples(index=False, name=None)]
+        return self._do_jobs
+
+    @property
+    def e_do_jobs_dict(self)->dict:
+        if self._do_jobs_dict is None:
+            self._do_jobs_dict = {}
+            for job in self.e_do_jobs:
+                self._do_jobs_dict.setdefault(job.job_type_id, {})[job.sub_type_id] = job.finish_count
+        return self._do_jobs_dict
+
+    @instrumentation.stage("load_jobs_from_file")
     def load_jobs_from_file(self, file_path: str = None):
-        data_frame = pd.read_excel(file_path, sheet_name="员工产值明细",
-                                   header=1, usecols=[0, 1, 2],
-                                   dtype={"款号": np.int, "工序": np.int, "数量": np.int},
-                                   comment="小计", convert_float=True, verbose=True)
-        for index, row in data_frame.iterrows():
-            new_job = Job(row["款号"], row["工序"], row["数量"])
-            self.add_job(new_job)
+        """
+        逐块读取“员工产值明细”，每块读完就合并到e_jobs
+        """
+        rows = _iter_sheet_rows(file_path, "员工产值明细", min_row=3)
+        try:
+            for df_chunk in _iter_job_chunks(rows, file_path):
+                self.add_jobs(df_chunk)
+        finally:
+            rows.close()
+
+    def add_jobs(self, df_jobs: DataFrame):
+        """
+        批量添加工作记录，重复的(款号, 工序)在一次聚合中合并
+        :param df_jobs: DataFrame[job_type_id, sub_type_id, finish_count]
+        :return:
+        """
+        df = pd.concat([self.e_jobs, df_jobs[JOB_COLUMNS]], ignore_index=True)
+        df_dup = df[df.duplicated(["job_type_id", "sub_type_id"])]
+        instrumentation.count("rows", len(df_jobs))
+        instrumentation.count("duplicate_merges", len(df_dup))
+        for (job_type_id, sub_type_id) in df_dup[["job_type_id", "sub_type_id"]].itertuples(index=False, name=None):
+            logging.warning("员工工作记录有重复项%s %d %d" %
+                            (self.e_name, job_type_id, sub_type_id))
+        if len(df_dup):
+            self.e_duplicates = pd.concat([self.e_duplicates, df_dup[JOB_COLUMNS]], ignore_index=True).astype(np.int64)
+            df = df.groupby(["job_type_id", "sub_type_id"], sort=False, as_index=False)["finish_count"].sum()
+        self.e_jobs = df.astype(np.int64)
+        self.e_version += 1
+        self._do_jobs = None
+        self._do_jobs_dict = None
 
     def add_job(self, job: Job):
-        if job.job_type_id not in self.e_do_jobs_dict:
-            self.e_do_jobs_dict[job.job_type_id] = {}
+        self.add_jobs(DataFrame([(job.job_type_id, job.sub_type_id, job.finish_count)],
+                                columns=JOB_COLUMNS))
 
-        if job.sub_type_id in self.e_do_jobs_dict[job.job_type_id]:
-            logging.warning("员工工作记录有重复项%s %d %d" %
-                            (self.e_name, job.job_type_id, job.sub_type_id))
-            for job_loop in self.e_do_jobs:
-                if job_loop.job_type_id == job.job_type_id and job_loop.sub_type_id == job.sub_type_id:
-                    job_loop.finish_count += job.finish_count
-            self.e_do_jobs_dict[job.job_type_id][job.sub_type_id] += job.finish_count
+
+class ParseCache:
+    """
+    A on-disk cache of parsed workbooks, one .npz file per workbook
+    Attr:
+        p_cache_dir: cache directory
+        p_max_bytes: max total size of the cache, least recently used entries are evicted first
+    Entry file name is "<hash of kind + path>.npz" and the entry keeps the size and mtime of the
+    workbook, so a changed workbook misses the cache and saving it replaces its old entry in place.
+    """
+    def __init__(self, cache_dir: str, max_bytes: int = 256 * 1024 * 1024):
+        self.p_cache_dir = cache_dir
+        self.p_max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path_prefix(self, kind: str, file_path: str)->str:
+        return hashlib.sha1(("%s|%s" % (kind, os.path.abspath(file_path))).encode("utf-8")).hexdigest()
+
+    def _entry_path(self, kind: str, file_path: str)->str:
+        return os.path.join(self.p_cache_dir, "%s.npz" % self._path_prefix(kind, file_path))
+
+    @staticmethod
+    def _file_version(file_path: str)->str:
+        stat = os.stat(file_path)
+        return "%d|%d" % (stat.st_size, stat.st_mtime_ns)
+
+    def _load(self, kind: str, file_path: str):
+        entry_path = self._entry_path(kind, file_path)
+        if not os.path.exists(entry_path):
+            return None
+        try:
+            with np.load(entry_path, allow_pickle=False) as npz:
+                if "file_version" not in npz.files or str(npz["file_version"]) != self._file_version(file_path):
+                    return None
+                arrays = {key: npz[key] for key in npz.files if key != "file_version"}
+        except Exception as e:
+            logging.warning("ParseCache: drop broken entry %s %s\n" % (entry_path, repr(e)))
+            os.remove(entry_path)
+            return None
+        os.utime(entry_path)
+        return arrays
+
+    def _save(self, kind: str, file_path: str, evict: bool, **arrays):
+        """
+        :param evict: 保存后检查缓存大小，一次保存很多文件时由调用者在最后调用一次evict
+        """
+        entry_path = self._entry_path(kind, file_path)
+        tmp_path = entry_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, file_version=np.array(self._file_version(file_path)), **arrays)
+        os.replace(tmp_path, entry_path)
+        if evict:
+            self.evict()
+
+    def load_employee(self, file_path: str):
+        """
+        :return: _read_employee_file的结果, None if not cached
+        """
+        arrays = self._load("employee", file_path)
+        if arrays is None or "duplicate_" + JOB_COLUMNS[0] not in arrays:
+            return None
+        name, eid = json.loads(str(arrays["header"]))
+        return name, eid, DataFrame({column: arrays[column] for column in JOB_COLUMNS}), \
+            DataFrame({column: arrays["duplicate_" + column] for column in JOB_COLUMNS})
+
+    def save_employee(self, file_path: str, result: tuple, evict: bool = True):
+        """
+        :param evict: False时不检查缓存大小，保存完一批文件后调用evict
+        """
+        name, eid, df_jobs, df_duplicates = result
+        arrays = {column: df_jobs[column].to_numpy(np.int64) for column in JOB_COLUMNS}
+        arrays.update({"duplicate_" + column: df_duplicates[column].to_numpy(np.int64) for column in JOB_COLUMNS})
+        self._save("employee", file_path, evict, header=np.array(json.dumps([name, eid])), **arrays)
+
+    def load_job_type_book(self, file_path: str):
+        """
+        :return: JobTypeBook, None if not cached
+        """
+        arrays = self._load("job_type_book", file_path)
+        if arrays is None:
+            return None
+        dict_job_types = {jid: JobType(jid) for jid in arrays["job_ids"].tolist()}
+        for (jid, sid, name, price) in zip(arrays["job_type_id"].tolist(), arrays["sub_type_id"].tolist(),
+                                           json.loads(str(arrays["names"])), arrays["price"].tolist()):
+            dict_job_types[jid].add_sub_type(sid, name, price)
+        book = JobTypeBook()
+        book.b_dict_job_types = dict_job_types
+        book._build_index()
+        return book
+
+    def save_job_type_book(self, file_path: str, book):
+        sub_types = [(job_type.j_id, sub_type)
+                     for job_type in book.b_dict_job_types.values()
+                     for sub_type in job_type.j_dict_sub_types.values()]
+        self._save("job_type_book", file_path, True,
+                   job_ids=np.array(list(book.b_dict_job_types.keys()), dtype=np.int64),
+                   job_type_id=np.array([jid for (jid, _) in sub_types], dtype=np.int64),
+                   sub_type_id=np.array([sub_type.s_id for (_, sub_type) in sub_types], dtype=np.int64),
+                   names=np.array(json.dumps([sub_type.s_name for (_, sub_type) in sub_types])),
+                   price=np.array([sub_type.s_price for (_, sub_type) in sub_types], dtype=np.float64))
+
+    def invalidate(self, file_path: str = None, kind: str = None):
+        """
+        删除缓存
+        :param file_path: 只删除这个文件的缓存，None表示清空整个缓存
+        :param kind: "employee" 或 "job_type_book"，None表示两种都删除
+        :return:
+        """
+        if file_path is None:
+            list_entry_path = [os.path.join(self.p_cache_dir, entry) for entry in os.listdir(self.p_cache_dir)
+                               if entry.endswith(".npz")]
+        else:
+            list_entry_path = [self._entry_path(_kind, file_path)
+                               for _kind in ([kind] if kind else ["employee", "job_type_book"])]
+        for entry_path in list_entry_path:
+            if os.path.exists(entry_path):
+                os.remove(entry_path)
+
+    def evict(self):
+        """
+        缓存超过p_max_bytes时，按最近使用时间删除最旧的缓存
+        """
+        list_entry = []
+        for entry in os.listdir(self.p_cache_dir):
+            if entry.endswith(".npz"):
+                stat = os.stat(os.path.join(self.p_cache_dir, entry))
+                list_entry.append((stat.st_mtime_ns, stat.st_size, entry))
+        total_bytes = sum(size for (_, size, _) in list_entry)
+        for (_, size, entry) in sorted(list_entry):
+            if total_bytes <= self.p_max_bytes:
+                break
+            os.remove(os.path.join(self.p_cache_dir, entry))
+            total_bytes -= size
+
+
+class HistoryStore:
+    """
+    A SQLite store of job records and price books of many months
+    Attr:
+        h_db_path: database file, ":memory:" for a temporary store
+        h_connection: sqlite3 connection, shared by all threads under h_lock
+        h_lock: lock held for every statement
+    Periods are "YYYY-MM" strings. Every changed price book saved gets a new version, jobs of a period
+    are paid with the latest version saved for that period or the closest earlier one.
+    """
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS price_book (
+        version INTEGER PRIMARY KEY AUTOINCREMENT,
+        period TEXT NOT NULL,
+        source TEXT,
+        created REAL NOT NULL);
+    CREATE INDEX IF NOT EXISTS idx_price_book_period ON price_book (period, version);
+    CREATE TABLE IF NOT EXISTS price_job_type (
+        version INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        job_type_id INTEGER NOT NULL,
+        PRIMARY KEY (version, position));
+    CREATE TABLE IF NOT EXISTS price (
+        version INTEGER NOT NULL,
+        job_type_id INTEGER NOT NULL,
+        sub_type_id INTEGER NOT NULL,
+        name TEXT,
+        price REAL);
+    CREATE INDEX IF NOT EXISTS idx_price_version ON price (version, job_type_id);
+    CREATE TABLE IF NOT EXISTS period_employee (
+        period TEXT NOT NULL,
+        employee_name TEXT NOT NULL,
+        employee_id INTEGER,
+        PRIMARY KEY (period, employee_name));
+    CREATE TABLE IF NOT EXISTS job (
+        period TEXT NOT NULL,
+        employee_name TEXT NOT NULL,
+        employee_id INTEGER,
+        job_type_id INTEGER NOT NULL,
+        sub_type_id INTEGER NOT NULL,
+        finish_count INTEGER NOT NULL);
+    CREATE INDEX IF NOT EXISTS idx_job_period ON job (period);
+    CREATE INDEX IF NOT EXISTS idx_job_employee ON job (employee_id, period);
+    CREATE INDEX IF NOT EXISTS idx_job_style ON job (job_type_id, period);
+    """
+
+    def __init__(self, db_path: str):
+        self.h_db_path = db_path
+        self.h_connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.h_lock = threading.Lock()
+        with self.h_lock:
+            if db_path != ":memory:":
+                self.h_connection.execute("PRAGMA journal_mode=WAL")
+            self.h_connection.execute("PRAGMA synchronous=NORMAL")
+            self.h_connection.executescript(self.SCHEMA)
+
+    def close(self):
+        with self.h_lock:
+            self.h_connection.close()
+
+    @staticmethod
+    def _check_period(period: str):
+        try:
+            valid = len(period) == 7 and time.strptime(period, "%Y-%m")
+        except (TypeError, ValueError):
+            valid = False
+        if not valid:
+            raise Exception("月份格式不正确（%s），应为YYYY-MM" % period)
+
+    @instrumentation.stage("history_save_job_type_book")
+    def save_job_type_book(self, book: JobTypeBook, period: str, source: str = None)->int:
+        """
+        保存单价本的一个新版本，与这个月最新的版本完全相同时不保存
+        :param period: 从这个月开始使用
+        :param source: 单价本文件，只用于记录
+        :return: version, 没有保存时为已有的版本
+        """
+        self._check_period(period)
+        list_job_id = list(book.b_dict_job_types.keys())
+        records = [(job_type.j_id, sub_type.s_id, sub_type.s_name, sub_type.s_price)
+                   for job_type in book.b_dict_job_types.values()
+                   for sub_type in job_type.j_dict_sub_types.values()]
+        with self.h_lock, self.h_connection:
+            # 1 the same book saved again for this period keeps its version
+            row = self.h_connection.execute("SELECT version FROM price_book WHERE period = ? "
+                                            "ORDER BY version DESC LIMIT 1", (period, )).fetchone()
+            if row is not None and self._read_price_rows(row[0]) == (list_job_id, records):
+                return row[0]
+
+            # 2 a new version
+            cursor = self.h_connection.execute("INSERT INTO price_book (period, source, created) VALUES (?, ?, ?)",
+                                               (period, source, time.time()))
+            version = cursor.lastrowid
+            self.h_connection.executemany(
+                "INSERT INTO price_job_type (version, position, job_type_id) VALUES (?, ?, ?)",
+                [(version, position, jid) for (position, jid) in enumerate(list_job_id)])
+            self.h_connection.executemany(
+                "INSERT INTO price (version, job_type_id, sub_type_id, name, price) VALUES (?, ?, ?, ?, ?)",
+                [(version, ) + record for record in records])
+        instrumentation.count("rows", len(records))
+        return version
+
+    def _read_price_rows(self, version: int)->tuple:
+        """
+        调用时必须已持有h_lock
+        :return: (款号列表, list of (job_type_id, sub_type_id, name, price))
+        """
+        list_job_id = [jid for (jid, ) in self.h_connection.execute(
+            "SELECT job_type_id FROM price_job_type WHERE version = ? ORDER BY position", (version, ))]
+        records = self.h_connection.execute("SELECT job_type_id, sub_type_id, name, price FROM price "
+                                            "WHERE version = ? ORDER BY rowid", (version, )).fetchall()
+        return list_job_id, records
+
+    def get_price_version(self, period: str)->int:
+        """
+        :return: period使用的单价本版本，没有时返回None
+        """
+        with self.h_lock:
+            row = self.h_connection.execute("SELECT version FROM price_book WHERE period <= ? "
+                                            "ORDER BY period DESC, version DESC LIMIT 1", (period, )).fetchone()
+        return None if row is None else row[0]
+
+    def load_job_type_book(self, version: int = None, period: str = None)->JobTypeBook:
+        """
+        :param version: 单价本版本
+        :param period: version为None时，加载这个月使用的单价本
+        :return: JobTypeBook, 没有时返回None
+        """
+        if version is None:
+            version = self.get_price_version(period)
+            if version is None:
+                return None
+        with self.h_lock:
+            list_job_id, records = self._read_price_rows(version)
+        if not list_job_id:
+            return None
+        dict_job_types = {jid: JobType(jid) for jid in list_job_id}
+        for (jid, sid, name, price) in records:
+            dict_job_types[jid].add_sub_type(sid, name, price)
+        book = JobTypeBook()
+        book.b_dict_job_types = dict_job_types
+        book._build_index()
+        return book
+
+    @instrumentation.stage("history_save_company")
+    def save_company(self, company: "Company", period: str):
+        """
+        保存一个月所有员工的工作记录，这个月之前保存的记录会被替换
+        """
+        self._check_period(period)
+        with company.c_lock:
+            list_employee = [(period, employee.e_name, employee.e_id)
+                             for employee in company.c_dict_employee.values()]
+            df_jobs = company.get_job_table()
+        dict_eid = {name: eid for (_, name, eid) in list_employee}
+        records = [(period, name, dict_eid[name], job_type_id, sub_type_id, finish_count)
+                   for (name, job_type_id, sub_type_id, finish_count)
+                   in df_jobs[["employee"] + JOB_COLUMNS].itertuples(index=False, name=None)]
+        with self.h_lock, self.h_connection:
+            self.h_connection.execute("DELETE FROM job WHERE period = ?", (period, ))
+            self.h_connection.execute("DELETE FROM period_employee WHERE period = ?", (period, ))
+            self.h_connection.executemany(
+                "INSERT INTO period_employee (period, employee_name, employee_id) VALUES (?, ?, ?)", list_employee)
+            self.h_connection.executemany(
+                "INSERT INTO job (period, employee_name, employee_id, job_type_id, sub_type_id, finish_count) "
+                "VALUES (?, ?, ?, ?, ?, ?)", records)
+        instrumentation.count("rows", len(records))
+
+    def list_periods(self)->list:
+        with self.h_lock:
+            return [period for (period, ) in self.h_connection.execute(
+                "SELECT DISTINCT period FROM period_employee ORDER BY period")]
+
+    def query_jobs(self, period_from: str = None, period_to: str = None,
+                   employee_id: int = None, job_type_id: int = None)->DataFrame:
+        """
+        查询工作记录，参数为None表示不限制
+          | period  | employee | employee_id | job_type_id | sub_type_id | finish_count
+        0 | 2024-05 | 张三     | 1           | 180072      | 1           | 100
+        :return: DataFrame
+        """
+        list_cond, list_param = [], []
+        for (cond, param) in [("period >= ?", period_from), ("period <= ?", period_to),
+                              ("employee_id = ?", employee_id), ("job_type_id = ?", job_type_id)]:
+            if param is not None:
+                list_cond.append(cond)
+                list_param.append(param)
+        sql = "SELECT period, employee_name, employee_id, job_type_id, sub_type_id, finish_count FROM job"
+        if list_cond:
+            sql += " WHERE " + " AND ".join(list_cond)
+        with self.h_lock:
+            records = self.h_connection.execute(sql + " ORDER BY period, rowid", list_param).fetchall()
+        return DataFrame(records, columns=["period", "employee", "employee_id"] + JOB_COLUMNS)
+
+    @instrumentation.stage("history_query_salary_matrix")
+    def query_salary_matrix(self, period_from: str, period_to: str)->DataFrame:
+        """
+        计算几个月的工资总和，每个月按这个月使用的单价本计算，
+        只有一个月时与那个月的export_employee_salary_sheet结果相同
+        :return: DataFrame, index为员工姓名（已排序），columns为各月单价本中的款号
+        """
+        self._check_period(period_from)
+        self._check_period(period_to)
+        list_name, list_job_type_id = [], []
+        set_name, set_job_type_id = set(), set()
+        list_part = []
+        dict_book = {}
+        for period in self.list_periods():
+            if not period_from <= period <= period_to:
+                continue
+            # 1 the price book used in this period
+            version = self.get_price_version(period)
+            if version is None:
+                raise Exception("%s没有可用的单价本" % period)
+            if version not in dict_book:
+                dict_book[version] = self.load_job_type_book(version)
+            book = dict_book[version]
+
+            # 2 salary of this period, rows in the order they were saved
+            with self.h_lock:
+                list_period_name = [name for (name, ) in self.h_connection.execute(
+                    "SELECT employee_name FROM period_employee WHERE period = ?", (period, ))]
+                records = self.h_connection.execute(
+                    "SELECT employee_name, job_type_id, sub_type_id, finish_count FROM job "
+                    "WHERE period = ? ORDER BY rowid", (period, )).fetchall()
+            instrumentation.count("rows", len(records))
+            df_jobs = DataFrame(records, columns=["employee"] + JOB_COLUMNS)
+            list_part.append((list_period_name, list(book.b_dict_job_types.keys()),
+                              _sum_salary_matrix(df_jobs, list_period_name, book)))
+            list_name += [name for name in list_period_name if name not in set_name]
+            list_job_type_id += [jid for jid in book.b_dict_job_types.keys() if jid not in set_job_type_id]
+            set_name.update(list_period_name)
+            set_job_type_id.update(book.b_dict_job_types.keys())
+
+        # 3 add up periods
+        matrix = np.zeros((len(list_name), len(list_job_type_id)))
+        index_name, index_job_type = pd.Index(list_name), pd.Index(list_job_type_id)
+        for (list_period_name, list_period_job_type_id, part) in list_part:
+            matrix[np.ix_(index_name.get_indexer(list_period_name),
+                          index_job_type.get_indexer(list_period_job_type_id))] += part
+        return DataFrame(matrix, index=list_name, columns=list_job_type_id).sort_index()
+
+    def export_employee_salary_sheet(self, file_path: str, period_from: str, period_to: str):
+        df = self.query_salary_matrix(period_from, period_to)
+        instrumentation.count("rows", len(df))
+        _write_employee_salary_sheet(file_path, df)
+
+
+def _write_table(df: DataFrame, file_path: str, fmt: str):
+    """
+    不经过Excel写出一张表格
+    :param fmt: "csv", "parquet"或"feather"，后两种需要安装pyarrow
+    """
+    if fmt == "csv":
+        # with a BOM, so that Excel reads the Chinese names as utf-8
+        df.to_csv(file_path, index=False, encoding="utf-8-sig")
+        return
+    if fmt not in ("parquet", "feather"):
+        raise Exception("不支持的导出格式%s" % fmt)
+    try:
+        if fmt == "parquet":
+            df.to_parquet(file_path, index=False)
+        else:
+            df.to_feather(file_path)
+    except ImportError:
+        raise Exception("导出%s格式需要安装pyarrow" % fmt)
+
+
+def _write_job_type_output_sheet(file_path: str, dict_job_type_book: dict, progress=None,
+                                 cancel_event: threading.Event = None):
+    """
+    写出产量表，每个款号一个表格，用openpyxl的write-only模式逐行写出
+    :param dict_job_type_book: Company.get_job_type_output_tables()
+    """
+    work_book = openpyxl.Workbook(write_only=True)
+    bold_font = openpyxl.styles.Font(bold=True)
+
+    def bold_cell(work_sheet, value: str):
+        cell = openpyxl.cell.WriteOnlyCell(work_sheet, value=value)
+        cell.font = bold_font
+        return cell
+
+    for (done, (job_type, dict_sub_type)) in enumerate(dict_job_type_book.items(), start=1):
+        if cancel_event is not None and cancel_event.is_set():
+            # finish the sheets already started, the workbook is not saved
+            for work_sheet in work_book.worksheets:
+                work_sheet.close()
+            raise CancelledError()
+        work_sheet = work_book.create_sheet(title=str(job_type))
+        ncols = max(len(row) for row in dict_sub_type.values()) - 1
+        work_sheet.append([bold_cell(work_sheet, "工序号")] +
+                          [bold_cell(work_sheet, "数量" if col_loop % 2 else "工号")
+                           for col_loop in range(ncols)])
+        for row in dict_sub_type.values():
+            work_sheet.append(row)
+        if progress is not None:
+            progress(done, len(dict_job_type_book), job_type)
+    if not dict_job_type_book:
+        work_book.create_sheet(title="Sheet1")
+
+    work_book.save(file_path)
+
+
+def _write_employee_salary_sheet(file_path: str, df: DataFrame, progress=None,
+                                 cancel_event: threading.Event = None):
+    """
+    写出工资总表，整张表一次写出，只能在开始之前取消
+    """
+    if cancel_event is not None and cancel_event.is_set():
+        raise CancelledError()
+    df.to_excel(file_path, sheet_name="员工工资总表", engine="openpyxl")
+    if progress is not None:
+        progress(1, 1, "员工工资总表")
+
+
+_report_cancel_event = None
+_report_progress_queue = None
+
+
+def _init_report_writer(cancel_event, progress_queue):
+    """
+    写文件的子进程的initializer，multiprocessing的Event和Queue只能在创建进程时传入
+    """
+    global _report_cancel_event, _report_progress_queue
+    _report_cancel_event = cancel_event
+    _report_progress_queue = progress_queue
+
+
+def _write_report(index: int, func, file_path: str, data):
+    """
+    在子进程中写出一个文件，进度通过队列送回主进程，主进程设置cancel_event后在下一个表格之前停止
+    """
+    func(file_path, data, lambda done, total, item: _report_progress_queue.put((index, done, total, item)),
+         _report_cancel_event)
+
+
+def _check_export_formats(list_fmt: list):
+    """
+    在加载数据之前检查导出格式是否可用
+    """
+    for fmt in list_fmt:
+        if fmt not in EXPORT_FORMATS:
+            raise Exception("不支持的导出格式%s" % fmt)
+        if fmt in ("parquet", "feather") and importlib.util.find_spec("pyarrow") is None:
+            raise Exception("导出%s格式需要安装pyarrow" % fmt)
+
+
+def _sum_salary_matrix(df_jobs: DataFrame, list_name: list, book: JobTypeBook)->np.ndarray:
+    """
+    按单价本计算工资，结果的行与list_name对应，列与单价本中的款号对应
+    :param df_jobs: 长表，格式同Company.get_job_table
+    :return: 2-D array, len(list_name) x 单价本中的款号数
+    """
+    list_job_type_id = list(book.b_dict_job_types.keys())
+    # 1 only job types in the price book are paid
+    array_col = pd.Index(list_job_type_id).get_indexer(df_jobs["job_type_id"])
+    df_jobs = df_jobs[array_col >= 0]
+
+    # 2 look up prices in the price index
+    array_price, array_valid = book.query_prices(df_jobs["job_type_id"].to_numpy(),
+                                                 df_jobs["sub_type_id"].to_numpy())
+    df_missing = df_jobs[~array_valid]
+    if len(df_missing):
+        job_id, sub_id = df_missing.iloc[0][["job_type_id", "sub_type_id"]]
+        logging.error("_sum_salary_matrix: Invalid job id %d or sub id %d\n"
+                      % (job_id, sub_id))
+        raise Exception("所要求的货品ID无效（%d-%d）\n"
+                        % (job_id, sub_id))
+
+    # 3 sum salary into a preallocated employee x job type matrix
+    matrix = np.zeros((len(list_name), len(list_job_type_id)))
+    np.add.at(matrix,
+              (pd.Index(list_name).get_indexer(df_jobs["employee"]),
+               pd.Index(list_job_type_id).get_indexer(df_jobs["job_type_id"])),
+              array_price * df_jobs["finish_count"].to_numpy(np.float64))
+    return matrix
+
+
+class AggregateCube:
+    """
+    Counts and amounts of every (employee, job_type_id, sub_type_id), built once from the loaded jobs
+    Attr:
+        a_table: DataFrame[job_type_id, sub_type_id, employee, employee_id, finish_count, amount, unpriced], see
+                 Company.get_long_table, amount is NaN and unpriced is 1 where the price book has no price
+        a_rollups: cached rollups and top-N tables, dict[key(tuple): DataFrame]
+    The cube never changes, Company.get_cube builds a new one when the jobs or prices change,
+    which drops all cached rollups with it.
+    """
+    DIMENSIONS = ("employee", "job_type_id", "sub_type_id")
+    MEASURES = ("finish_count", "amount", "unpriced")
+
+    def __init__(self, df_long: DataFrame):
+        # sums skip the NaN amounts, so unpriced keeps how many records they leave out
+        self.a_table = df_long.assign(unpriced=df_long["amount"].isna().astype(np.int64))
+        self.a_rollups: dict = {}
+        self._lock = threading.Lock()
+
+    def _check_dims(self, by: tuple):
+        for dim in by:
+            if dim not in self.DIMENSIONS:
+                raise ValueError("维度必须是%s之一" % "、".join(self.DIMENSIONS))
+
+    @instrumentation.stage("cube_rollup")
+    def rollup(self, by: tuple = ())->DataFrame:
+        """
+        按维度汇总，从已缓存的更细的汇总表再汇总，没有时才遍历a_table
+        :param by: DIMENSIONS中的几项，()表示总计
+        :return: DataFrame, index为by，columns为MEASURES，amount不含没有单价的记录，unpriced为这些记录数，
+                 只读，不要修改
+        """
+        by = tuple(by)
+        self._check_dims(by)
+        key = ("rollup", ) + by
+        with self._lock:
+            if key in self.a_rollups:
+                instrumentation.count("cache_hits")
+                return self.a_rollups[key]
+            # 1 the smallest cached rollup which still has all the dimensions
+            df_source = self.a_table
+            for (_key, df) in self.a_rollups.items():
+                if _key[0] == "rollup" and set(by) <= set(_key[1:]) and len(df) < len(df_source):
+                    df_source = df.reset_index() if _key[1:] else df
+        instrumentation.count("rows", len(df_source))
+
+        # 2 sum the measures
+        if by:
+            df = df_source.groupby(list(by), sort=True)[list(self.MEASURES)].sum()
+        else:
+            df = DataFrame({measure: [df_source[measure].sum()] for measure in self.MEASURES})
+        with self._lock:
+            return self.a_rollups.setdefault(key, df)
+
+    def top(self, n: int, within: tuple = ("job_type_id", "sub_type_id"), rank: str = "employee",
+            measure: str = "finish_count")->DataFrame:
+        """
+        每组前n名，例如默认参数为每个工序产量最多的n个员工
+        :param within: 分组的维度
+        :param rank: 排名的维度，不能在within中
+        :param measure: MEASURES中的一项，按它排名
+        :return: DataFrame, 按within排序，组内按measure从大到小，只读，不要修改
+        """
+        within = tuple(within)
+        self._check_dims(within + (rank, ))
+        if rank in within or measure not in self.MEASURES:
+            raise ValueError("rank不能在within中，measure必须是%s之一" % "、".join(self.MEASURES))
+        key = ("top", n, within, rank, measure)
+        with self._lock:
+            if key in self.a_rollups:
+                return self.a_rollups[key]
+        df = self.rollup(within + (rank, )).reset_index()
+        df = df.sort_values(list(within) + [measure, rank], ascending=[True] * len(within) + [False, True],
+                            kind="stable")
+        if within:
+            df = df.groupby(list(within), sort=False).head(n)
         else:
-            self.e_do_jobs.append(job)
-            self.e_do_jobs_dict[job.job_type_id][job.sub_type_id] = job.finish_count
+            df = df.head(n)
+        df = df.reset_index(drop=True)
+        with self._lock:
+            return self.a_rollups.setdefault(key, df)
 
 
 class Company:
@@ -198,15 +1464,255 @@ class Company:
     Attr:
         c_dict_employee: employees owned by the company, dict[name(str): Employee]
         c_job_type_book: job type book
+        c_parse_cache: cache of parsed employee files, None means no cache
+        c_dict_file_employee: employee loaded from each file, dict[file_path(str): name(str)]
+        c_salary_rows: cached rows of calc_salary_matrix, dict[name(str): np.ndarray]
+        c_output_tables: cached result of get_job_type_output_tables, None means not built
+        c_cube: cached result of get_cube, None means not built
+        c_lock: lock for using the company from several threads, held while employees are merged
+    Employees should be added, replaced and removed through set_employee/remove_employee,
+    and prices changed through set_price, so that only the affected cached rows and
+    output tables are recalculated. Jobs added to an employee in place are noticed through
+    Employee.e_version.
     """
     def __init__(self):
         self.c_dict_employee: dict[str:Employee] = {}
         self.c_job_type_book: JobTypeBook = None
+        self.c_parse_cache: ParseCache = None
+        self.c_dict_file_employee: dict[str:str] = {}
+        self.c_salary_rows: dict[str:np.ndarray] = {}
+        self.c_output_tables: dict = None
+        self.c_cube: AggregateCube = None
+        self._cube_version: tuple = None
+        self.c_lock = threading.RLock()
+        self._salary_book: JobTypeBook = None
+        self._salary_book_version: int = None
+        self._salary_row_versions: dict[str:int] = {}
+        self._output_versions: dict[str:int] = {}
+        self._set_dirty_job_types: set = set()
 
     def add_employee(self, name: str, eid: int, file_path: str):
         e: Employee = Employee(name, eid, file_path)
-        self.c_dict_employee[e.e_name] = e
+        self.set_employee(e, file_path)
+
+    def _invalidate_employee(self, employee: Employee):
+        self.c_salary_rows.pop(employee.e_name, None)
+        self._set_dirty_job_types.update(employee.e_jobs["job_type_id"].tolist())
+
+    def set_employee(self, employee: Employee, file_path: str = None):
+        """
+        添加或替换一个员工，只让这个员工的工资和他做过的款号的产量表失效
+        :param employee: 员工，同名员工会被替换
+        :param file_path: 员工文件，同一个文件之前加载的其他员工会被移除
+        :return:
+        """
+        if file_path is not None:
+            old_name = self.c_dict_file_employee.get(file_path)
+            if old_name is not None and old_name != employee.e_name:
+                self.remove_employee(old_name)
+        if employee.e_name in self.c_dict_employee:
+            self._invalidate_employee(self.c_dict_employee[employee.e_name])
+        self.c_dict_employee[employee.e_name] = employee
+        self._invalidate_employee(employee)
+        if file_path is not None:
+            self.c_dict_file_employee[file_path] = employee.e_name
+
+    def remove_employee(self, name: str):
+        if name not in self.c_dict_employee:
+            return
+        self._invalidate_employee(self.c_dict_employee.pop(name))
+        for _file in [_file for (_file, _name) in self.c_dict_file_employee.items() if _name == name]:
+            del self.c_dict_file_employee[_file]
+
+    def set_price(self, job_id: int, sub_id: int, price: float):
+        """
+        修改单价，只重新计算做过这个工序的员工在这个款号上的工资
+        """
+        book = self.c_job_type_book
+        up_to_date = self._salary_book is book and self._salary_book_version == book.b_version
+        book.set_price(job_id, sub_id, price)
+        if not up_to_date:
+            return
+        self._salary_book_version = book.b_version
+        col = book.b_job_row[job_id]
+        for (name, row) in self.c_salary_rows.items():
+            df_jobs = self.c_dict_employee[name].e_jobs
+            df_jobs = df_jobs[df_jobs["job_type_id"] == job_id]
+            if not (df_jobs["sub_type_id"] == sub_id).any():
+                continue
+            array_price, _ = book.query_prices(df_jobs["job_type_id"].to_numpy(), df_jobs["sub_type_id"].to_numpy())
+            row[col] = sum(array_price * df_jobs["finish_count"].to_numpy(np.float64))
+
+    def scan_directory(self, dir_path: str, snapshot: dict = None, workers: int = None)->tuple:
+        """
+        扫描目录中的员工文件，只重新加载新增或修改过的文件，已删除文件的员工被移除
+        :param dir_path: 员工文件目录
+        :param snapshot: 上次扫描的结果，dict[file_path(str): (size, mtime)]，None表示第一次扫描
+        :param workers: 同load_employees
+        :return: (snapshot, list of changed files, list of removed files, dict_error)
+        """
+        snapshot = snapshot or {}
+        new_snapshot = {}
+        for _file in _expand_employee_paths([dir_path]):
+            try:
+                stat = os.stat(_file)
+            except OSError:
+                continue
+            new_snapshot[_file] = (stat.st_size, stat.st_mtime_ns)
+        list_changed = [_file for (_file, version) in new_snapshot.items() if snapshot.get(_file) != version]
+        list_removed = [_file for _file in snapshot if _file not in new_snapshot]
+        for _file in list_removed:
+            if _file in self.c_dict_file_employee:
+                self.remove_employee(self.c_dict_file_employee[_file])
+        dict_error = self.load_employees(list_changed, workers=workers) if list_changed else {}
+        return new_snapshot, list_changed, list_removed, dict_error
+
+    def watch_directory(self, dir_path: str, on_change=None, interval: float = 1.0,
+                        stop_event: threading.Event = None, workers: int = None):
+        """
+        持续监视目录，文件变化时增量更新，直到stop_event被设置
+        :param on_change: 每次有变化后调用on_change(list_changed, list_removed, dict_error)
+        """
+        snapshot = None
+        while stop_event is None or not stop_event.is_set():
+            snapshot, list_changed, list_removed, dict_error = self.scan_directory(dir_path, snapshot, workers)
+            if (list_changed or list_removed) and on_change is not None:
+                on_change(list_changed, list_removed, dict_error)
+            if stop_event is not None:
+                stop_event.wait(interval)
+            else:
+                time.sleep(interval)
 
+    @instrumentation.stage("load_employees")
+    def load_employees(self, file_paths: list, workers: int = None,
+                       progress=None, cancel_event: threading.Event = None)->dict:
+        """
+        用进程池并行读取多个员工文件，每个文件只解析一次，结果合并到c_dict_employee
+        :param file_paths: 员工文件列表
+        :param workers: 进程数，默认为CPU核数，1表示在当前进程中读取
+        :param progress: 每个文件处理完后调用progress(done, total, file_path)
+        :param cancel_event: 被设置后不再加载剩下的文件，已加载的员工保留
+        设置了c_parse_cache时，未修改过的文件直接从缓存读取
+        :return: 加载失败的文件，dict[file_path(str): error message(str)]
+        """
+        dict_error = {}
+        # 1 files unchanged since last run come from the cache
+        dict_cached = {}
+        if self.c_parse_cache is not None:
+            for _file in file_paths:
+                try:
+                    dict_cached[_file] = self.c_parse_cache.load_employee(_file)
+                except OSError:
+                    dict_cached[_file] = None
+        list_parse = [_file for _file in file_paths if dict_cached.get(_file) is None]
+        instrumentation.count("files", len(file_paths))
+        instrumentation.count("cache_hits", len(file_paths) - len(list_parse))
+
+        # 2 parse the others
+        executor = None
+        if workers != 1 and len(list_parse) > 1:
+            executor = ProcessPoolExecutor(max_workers=workers)
+        try:
+            dict_future = {_file: executor.submit(_parse_employee_file, _file) if executor else None
+                           for _file in list_parse}
+            for (done, _file) in enumerate(file_paths, start=1):
+                if cancel_event is not None and cancel_event.is_set():
+                    logging.info("load_employees: cancelled\n")
+                    break
+                logging.debug("select %s \n" % _file)
+                try:
+                    if dict_cached.get(_file) is not None:
+                        name, eid, df_jobs, df_duplicates = dict_cached[_file]
+                    else:
+                        future = dict_future[_file]
+                        if future is not None:
+                            (name, eid, df_jobs, df_duplicates), wall_time = future.result()
+                            instrumentation.record("load_jobs_from_file", wall_time,
+                                                   rows=len(df_jobs) + len(df_duplicates),
+                                                   duplicate_merges=len(df_duplicates))
+                        else:
+                            name, eid, df_jobs, df_duplicates = _read_employee_file(_file)
+                        if self.c_parse_cache is not None:
+                            self.c_parse_cache.save_employee(_file, (name, eid, df_jobs, df_duplicates), evict=False)
+                except Exception as e:
+                    logging.error("load_employees: %s %s\n" % (_file, repr(e)))
+                    dict_error[_file] = repr(e)
+                else:
+                    employee = Employee(name, eid)
+                    employee.e_file_path = _file
+                    employee.add_jobs(df_jobs)
+                    employee.e_duplicates = df_duplicates
+                    with self.c_lock:
+                        self.set_employee(employee, _file)
+                if progress is not None:
+                    progress(done, len(file_paths), _file)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+        # 3 one eviction pass for the whole batch
+        if self.c_parse_cache is not None and list_parse:
+            self.c_parse_cache.evict()
+        return dict_error
+
+    @instrumentation.stage("load_consolidated_file")
+    def load_consolidated_file(self, file_path: str, sheet_name: str = None)->int:
+        """
+        加载包含多个员工的汇总表，同名员工会被替换
+        :param file_path: 汇总表文件
+        :param sheet_name: 表格名，None表示第一个表格
+        :return: 加载的员工数
+        """
+        list_result = _read_consolidated_file(file_path, sheet_name)
+        for (name, eid, df_jobs) in list_result:
+            employee = Employee(name, eid)
+            employee.e_file_path = file_path
+            employee.add_jobs(df_jobs)
+            with self.c_lock:
+                self.set_employee(employee)
+        return len(list_result)
+
+    @instrumentation.stage("validate_jobs")
+    def validate_jobs(self)->DataFrame:
+        """
+        导出前一次检查所有员工的工作记录，列出所有问题而不是遇到第一个就停止
+          | employee | file      | job_type_id | sub_type_id | finish_count | problem
+        0 | 张三     | 张三.xlsx | 180072      | 99          | 100          | 工序不在单价本中
+        problem为VALIDATION_ERRORS中的一项时导出会失败，其他的只是提醒
+        :return: DataFrame, 没有问题时为空
+        """
+        book = self.c_job_type_book
+        with self.c_lock:
+            list_name = list(self.c_dict_employee.keys())
+            df_jobs = self.get_job_table(list_name)
+            df_dup = pd.concat([DataFrame(columns=["employee"] + JOB_COLUMNS)] +
+                               [employee.e_duplicates.assign(employee=name)
+                                for (name, employee) in self.c_dict_employee.items() if len(employee.e_duplicates)],
+                               ignore_index=True)
+            dict_file = {name: employee.e_file_path for (name, employee) in self.c_dict_employee.items()}
+
+        # 1 anti-join against the price index, job types not in the book are not paid
+        array_job_known = book._job_index.get_indexer(df_jobs["job_type_id"]) >= 0
+        _, array_valid = book.query_prices(df_jobs["job_type_id"].to_numpy(), df_jobs["sub_type_id"].to_numpy())
+        df_invalid = df_jobs[array_job_known & ~array_valid]
+        # sub types which are in the book but have no price, checked one by one since they are rare
+        array_no_price = np.array([sub_id in book.b_dict_job_types[job_id].j_dict_sub_types
+                                   for (job_id, sub_id) in zip(df_invalid["job_type_id"], df_invalid["sub_type_id"])],
+                                  dtype=bool)
+        list_df = [df_jobs[~array_job_known].assign(problem=VALIDATION_UNKNOWN_JOB_TYPE),
+                   df_invalid[~array_no_price].assign(problem=VALIDATION_UNKNOWN_SUB_TYPE),
+                   df_invalid[array_no_price].assign(problem=VALIDATION_NO_PRICE),
+                   df_jobs[df_jobs["finish_count"] <= 0].assign(problem=VALIDATION_NON_POSITIVE_COUNT),
+                   df_dup.assign(problem=VALIDATION_DUPLICATE)]
+
+        # 2 one report, with the file of each employee
+        df = pd.concat(list_df, ignore_index=True)
+        df["file"] = df["employee"].map(dict_file)
+        instrumentation.count("rows", len(df_jobs))
+        instrumentation.count("problems", len(df))
+        return df[["employee", "file"] + JOB_COLUMNS + ["problem"]]
+
+    @instrumentation.stage("calc_employee_salary_in_job_type")
     def calc_employee_salary_in_job_type(self, name: str, job_type_id: int)->int:
         _sum = 0.0
         for job in self.c_dict_employee[name].e_do_jobs:
@@ -214,7 +1720,66 @@ class Company:
                 _sum += self.c_job_type_book.query_price_by_id(job.job_type_id, job.sub_type_id) * job.finish_count
         return _sum
 
-    def export_employee_salary_sheet(self, file_path: str):
+    def get_job_table(self, list_name: list = None)->DataFrame:
+        """
+        把所有员工的工作记录合并成一张长表
+          | employee | job_type_id | sub_type_id | finish_count
+        0 | 张三     | 180072      | 1           | 100
+        :param list_name: 只包含这些员工，None表示所有员工
+        :return: DataFrame
+        """
+        if list_name is None:
+            list_name = list(self.c_dict_employee.keys())
+        list_df = [self.c_dict_employee[name].e_jobs.assign(employee=name) for name in list_name]
+        if not list_df:
+            return DataFrame(columns=["employee"] + JOB_COLUMNS)
+        return pd.concat(list_df, ignore_index=True)[["employee"] + JOB_COLUMNS]
+
+    @instrumentation.stage("calc_salary_matrix")
+    def calc_salary_matrix(self, df_jobs: DataFrame = None)->DataFrame:
+        """
+        计算所有员工在所有款号上的工资，结果与逐个调用calc_employee_salary_in_job_type相同
+        只重新计算工资行已失效的员工，单价本被替换时全部重新计算
+                    job type 0 | job type 1 | job type 2 ...
+        employeeA | salary 0   | salary 1   | salary 2   ...
+        employeeB | salary 0   | salary 1   | salary 2   ...
+
+        :param df_jobs: 已经收集好的get_job_table()，给出时不再重新收集
+        :return: DataFrame, index为员工姓名，columns为单价本中的款号
+        """
+        book = self.c_job_type_book
+        if self._salary_book is not book or self._salary_book_version != book.b_version:
+            self.c_salary_rows = {}
+            self._salary_book = book
+            self._salary_book_version = book.b_version
+
+        list_missing = [name for (name, employee) in self.c_dict_employee.items()
+                        if name not in self.c_salary_rows or self._salary_row_versions[name] != employee.e_version]
+        if list_missing:
+            for (name, row) in zip(list_missing, self._calc_salary_rows(list_missing, df_jobs)):
+                self.c_salary_rows[name] = row
+                self._salary_row_versions[name] = self.c_dict_employee[name].e_version
+
+        list_name = list(self.c_dict_employee.keys())
+        list_job_type_id = list(book.b_dict_job_types.keys())
+        matrix = np.array([self.c_salary_rows[name] for name in list_name]).reshape(len(list_name),
+                                                                                    len(list_job_type_id))
+        return DataFrame(matrix, index=list_name, columns=list_job_type_id)
+
+    def _calc_salary_rows(self, list_name: list, df_jobs: DataFrame = None)->np.ndarray:
+        """
+        批量计算一部分员工的工资行
+        :param df_jobs: 包含list_name的get_job_table()，None时只收集这些员工
+        :return: 2-D array, len(list_name) x 单价本中的款号数
+        """
+        if df_jobs is None:
+            df_jobs = self.get_job_table(list_name)
+        elif len(list_name) != len(self.c_dict_employee):
+            df_jobs = df_jobs[df_jobs["employee"].isin(list_name)]
+        return _sum_salary_matrix(df_jobs, list_name, self.c_job_type_book)
+
+    @instrumentation.stage("export_employee_salary_sheet")
+    def export_employee_salary_sheet(self, file_path: str, verbose: bool = True):
         """
                     job type 0 | job type 1 | job type 2 ...
         employeeA | salary 0   | salary 1   | salary 2   ...
@@ -222,314 +1787,510 @@ class Company:
         employeeC | salary 0   | salary 1   | salary 2   ...
 
         :param file_path: file to output
+        :param verbose: print the whole table to stdout
         :return:
         """
-        # 2 init data frame
-        df = DataFrame()
-        for employee in self.c_dict_employee.values():
-            # each dict is a row in sheet
-            _dict = {}
-            for job_type in self.c_job_type_book.b_dict_job_types.values():
-                _dict[job_type.j_id] = self.calc_employee_salary_in_job_type(employee.e_name, job_type.j_id)
-            # add row to sheet
-            df = df.append(DataFrame(_dict, index=[employee.e_name]))
+        # 2 calc all salaries at once
+        with self.c_lock:
+            df = self.calc_salary_matrix()
 
         # 3 export to excel
         df = df.sort_index()
-        print(df.to_string())
-        df.to_excel(file_path, sheet_name="员工工资总表")
+        if verbose:
+            print(df.to_string())
+        instrumentation.count("rows", len(df))
+        _write_employee_salary_sheet(file_path, df)
         return
 
-    def export_job_type_output_sheet(self, file_path: str):
-        # 1. Generate dict
-        # dict_job_type_book structure ---
-        # dict_job_type_book[job_type_id]
-        #   = dict[sub_type_id]
-        #       = list
-        #           = (employee_id, job.finish_count)
-        dict_job_type_book = {}
-        for employee in self.c_dict_employee.values():
-            for job in employee.e_do_jobs:
-                if job.job_type_id not in dict_job_type_book:
-                    dict_job_type_book[job.job_type_id] = {}
-                if job.sub_type_id not in dict_job_type_book[job.job_type_id]:
-                    dict_job_type_book[job.job_type_id][job.sub_type_id] = []
-                dict_job_type_book[job.job_type_id][job.sub_type_id].append(employee.e_id)
-                dict_job_type_book[job.job_type_id][job.sub_type_id].append(job.finish_count)
-
-        # 2. create data frame
-        # output data frame :
-        # job_type: 180072
-        #   | e_id | count | e_id | count ...
-        # 0 |
-        # 1 |
-        dict_df = {}
-        for (job_type, dict_sub_type) in dict_job_type_book.items():
-            dict_df[job_type] = DataFrame()
-            for (sub_type, job_list) in dict_sub_type.items():
-                tmp_df = DataFrame(job_list, columns=[sub_type])
-                dict_df[job_type] = dict_df[job_type].append(tmp_df.T)
-            print(dict_df[job_type].to_string())
+    @instrumentation.stage("export_employee_salary_table")
+    def export_employee_salary_table(self, file_path: str, fmt: str):
+        """
+        与export_employee_salary_sheet相同的表格，写成csv/parquet/feather，第一列为员工姓名
+        """
+        with self.c_lock:
+            df = self.calc_salary_matrix()
+        df = df.sort_index()
+        df.columns = [str(job_type_id) for job_type_id in df.columns]
+        instrumentation.count("rows", len(df))
+        _write_table(df.rename_axis("employee").reset_index(), file_path, fmt)
 
-        # 2. save to file
-        work_book = xw.Book()
-        for (job_type, df) in dict_df.items():
-            work_sheet = work_book.sheets.add(name=str(job_type))
-            work_sheet.range("A1").value = df
-            work_sheet.range("A1").value = "工序号"
-            work_sheet.range("A1").api.Font.Bold = True
-            # work_cells = work_sheet.cells
-            for col_loop in range(len(df.columns)):
-                if col_loop % 2:
-                    work_sheet.range((1,col_loop+2)).value = "数量"
-                else:
-                    work_sheet.range((1,col_loop+2)).value = "工号"
-                work_sheet.range((1,col_loop+2)).api.Font.Bold = True
-
-        work_book.save(path=file_path)
-        work_book.close()
-
-
-class Application(tk.Frame):
-    btn_output: tk.Button
-    btn_quit: tk.Button
-    btn_select_employee: tk.Button
-    btn_select_price: tk.Button
-    btn_show_employees: tk.Button
-    btn_show_job_types: tk.Button
-    label_selected_employee: tk.Label
-    label_selected_jobtypes: tk.Label
-    label_status: tk.Label
-    listbox_err_report: tk.Listbox
-
-    def __init__(self, master=None):
-        super().__init__(master)
-        self.pack()
-        self.create_widgets()
-        self.my_company: Company = Company()
-
-    def create_widgets(self):
-        self.btn_output              = tk.Button(self, text="生成表格", command=self.btn_cmd_output, width=30)
-        self.btn_quit                = tk.Button(self, text="退出", command=root.destroy, width=10)
-        self.btn_select_employee     = tk.Button(self, text="加载员工", command=self.btn_cmd_add_employee)
-        self.btn_select_price        = tk.Button(self, text="加载价格", command=self.btn_cmd_select_price)
-        self.btn_show_employees      = tk.Button(self, text="...", command=self.btn_cmd_show_employees)
-        self.btn_show_job_types      = tk.Button(self, text="...", command=self.btn_cmd_show_job_types)
-        self.label_selected_employee = tk.Label(self, text="NA", width=20)
-        self.label_selected_jobtypes = tk.Label(self, text="NA", width=20)
-        self.label_status            = tk.Label(self, text="NA")
-        self.listbox_err_report      = tk.Listbox(self, width=40)
-
-        self.btn_select_employee.grid(row=0, column=0)
-        self.label_selected_employee.grid(row=0, column=1, columnspan=2)
-        self.btn_show_employees.grid(row=0, column=3)
-
-        self.btn_select_price.grid(row=1, column=0)
-        self.label_selected_jobtypes.grid(row=1, column=1, columnspan=2)
-        self.btn_show_job_types.grid(row=1, column=3)
-
-        self.btn_output.grid(row=2, column=0, columnspan=4)
-
-        self.label_status.grid(row=3, column=0, columnspan=2)
-        self.btn_quit.grid(row=3, column=2, columnspan=2)
-
-        self.listbox_err_report.grid(row=4, column=0, columnspan=4)
-
-        self.log_debug("初始化成功")
-
-    def btn_cmd_select_output_dir(self):
-        """
-        选择输出的目录按钮，记录在self.entry_output_dir中
-        :return:
+    def get_long_table(self)->DataFrame:
+        """
+        每个员工每个(款号, 工序)一行，单价本中没有的工序金额为NaN
+          | job_type_id | sub_type_id | employee | employee_id | finish_count | amount
+        0 | 180072      | 1           | 张三     | 1           | 100          | 50.0
+        :return: DataFrame, 按款号、工序排序
         """
-        dir_selected = tk.filedialog.askdirectory()
-        if dir_selected is not '':
-            self.entry_output_dir.delete(0, tk.END)
-            self.entry_output_dir.insert(0, string=dir_selected)
-            self.log_debug("成功选择输出目录")
+        with self.c_lock:
+            df = self.get_job_table()
+            dict_eid = {name: employee.e_id for (name, employee) in self.c_dict_employee.items()}
+        array_price, _ = self.c_job_type_book.query_prices(df["job_type_id"].to_numpy(), df["sub_type_id"].to_numpy())
+        df = df.assign(employee_id=df["employee"].map(dict_eid),
+                       amount=array_price * df["finish_count"].to_numpy(np.float64))
+        df = df.sort_values(["job_type_id", "sub_type_id"], kind="stable", ignore_index=True)
+        return df[["job_type_id", "sub_type_id", "employee", "employee_id", "finish_count", "amount"]]
+
+    @instrumentation.stage("export_long_table")
+    def export_long_table(self, file_path: str, fmt: str):
+        """
+        导出get_long_table，产量表的csv/parquet/feather格式
+        """
+        df = self.get_long_table()
+        instrumentation.count("rows", len(df))
+        _write_table(df, file_path, fmt)
 
-    def btn_cmd_add_employee(self):
+    def data_version(self)->tuple:
         """
-        添加员工按钮：添加到Company类中
-        :return:
+        :return: 单价本或任何员工的工作记录变化后都会不同的值
         """
-        list_file = tk.filedialog.askopenfilenames()
-        if len(list_file) != 0:
-            t = threading.Thread(target=self.handle_add_employees,
-                                 name="t_AddEmp",
-                                 args=(list_file, ))
-            t.start()
+        with self.c_lock:
+            book = self.c_job_type_book
+            return (id(book), book.b_version if book is not None else None) + \
+                tuple((name, id(employee), employee.e_version) for (name, employee) in self.c_dict_employee.items())
 
-    def btn_cmd_select_price(self):
+    @instrumentation.stage("get_cube")
+    def get_cube(self)->AggregateCube:
+        """
+        所有工作记录的汇总立方体，数据没有变化时返回同一个，它缓存的汇总表可以继续使用
+        """
+        with self.c_lock:
+            version = self.data_version()
+            if self.c_cube is None or self._cube_version != version:
+                self.c_cube = AggregateCube(self.get_long_table())
+                self._cube_version = version
+            return self.c_cube
+
+    def get_job_type_output_tables(self, df_jobs: DataFrame = None)->dict:
         """
-        选择单价本按钮：添加到Company中
+        生成每个款号的产量表，第一次遍历所有员工的工作记录，之后只重新生成有变化的款号
+        dict[job_type_id(int): dict[sub_type_id(int): row(list)]]
+        row = [sub_type_id, e_id, finish_count, e_id, finish_count, ...]
+        :param df_jobs: 已经收集好的get_job_table()，第一次生成时使用
+        :return: dict, 只读，不要修改
+        """
+        # jobs added in place only add job types, so the new job types cover the changes
+        for (name, employee) in self.c_dict_employee.items():
+            if self._output_versions.get(name, employee.e_version) != employee.e_version:
+                self._set_dirty_job_types.update(employee.e_jobs["job_type_id"].tolist())
+        self._output_versions = {name: employee.e_version for (name, employee) in self.c_dict_employee.items()}
+
+        if self.c_output_tables is None:
+            self.c_output_tables = self._build_job_type_output_tables(df_jobs=df_jobs)
+        elif self._set_dirty_job_types:
+            dict_update = self._build_job_type_output_tables(self._set_dirty_job_types)
+            for job_type_id in self._set_dirty_job_types:
+                self.c_output_tables.pop(job_type_id, None)
+            self.c_output_tables.update(dict_update)
+            # keep styles in the order they first appear
+            list_df = [employee.e_jobs["job_type_id"] for employee in self.c_dict_employee.values()]
+            list_order = pd.unique(pd.concat(list_df)).tolist() if list_df else []
+            self.c_output_tables = {job_type_id: self.c_output_tables[job_type_id] for job_type_id in list_order}
+        self._set_dirty_job_types = set()
+        return self.c_output_tables
+
+    def _build_job_type_output_tables(self, set_job_type_id: set = None, df_jobs: DataFrame = None)->dict:
+        dict_job_type_book = {}
+        if df_jobs is not None and set_job_type_id is None:
+            # rows of get_job_table are in the same order as the loop below
+            dict_eid = {name: employee.e_id for (name, employee) in self.c_dict_employee.items()}
+            for (name, job_type_id, sub_type_id, finish_count) \
+                    in df_jobs[["employee"] + JOB_COLUMNS].itertuples(index=False, name=None):
+                dict_sub_type = dict_job_type_book.setdefault(job_type_id, {})
+                dict_sub_type.setdefault(sub_type_id, [sub_type_id]).extend((dict_eid[name], finish_count))
+            return dict_job_type_book
+        for employee in self.c_dict_employee.values():
+            df_jobs = employee.e_jobs[JOB_COLUMNS]
+            if set_job_type_id is not None:
+                df_jobs = df_jobs[df_jobs["job_type_id"].isin(set_job_type_id)]
+            for (job_type_id, sub_type_id, finish_count) in df_jobs.itertuples(index=False, name=None):
+                dict_sub_type = dict_job_type_book.setdefault(job_type_id, {})
+                dict_sub_type.setdefault(sub_type_id, [sub_type_id]).extend((employee.e_id, finish_count))
+        return dict_job_type_book
+
+    @instrumentation.stage("export_job_type_output_sheet")
+    def export_job_type_output_sheet(self, file_path: str, progress=None, cancel_event: threading.Event = None):
+        """
+        每个款号一个表格，不经过Excel，用openpyxl的write-only模式逐行写出
+        job_type: 180072
+        工序号 | 工号 | 数量 | 工号 | 数量 ...
+        1      | e_id | count | e_id | count ...
+
+        :param file_path: file to output
+        :param progress: 每写完一个表格调用progress(done, total, job_type)
+        :param cancel_event: 被设置后抛出CancelledError，不保存文件
         :return:
         """
-        file_selected = tk.filedialog.askopenfilename()
-        if file_selected is not '':
-            t = threading.Thread(target=self.handle_set_price,
-                                 name="t_SetPri",
-                                 args=(file_selected,))
-            t.start()
-
-    def btn_cmd_show_employees(self):
-        text = "已加载员工：\n"
-        line_ctrl_cnt = 0
-        for (name, employee) in self.my_company.c_dict_employee.items():
-            text = text + name + " "
-            line_ctrl_cnt += 1
-            if not line_ctrl_cnt % 3:
-                text += "\n"
-        tk.messagebox.showinfo(message=text)
-
-    def btn_cmd_show_job_types(self):
-        text = "已加载工项号：\n"
-        line_ctrl_cnt = 0
-        for (id, job_type) in self.my_company.c_job_type_book.b_dict_job_types.items():
-            text = text + str(id) + " "
-            line_ctrl_cnt += 1
-            if not line_ctrl_cnt % 3:
-                text += "\n"
-        tk.messagebox.showinfo(message=text)
-
-    def btn_cmd_output(self):
-        """
-        程序执行按钮：产生输出文件
+        # 1. Generate rows of each sheet
+        with self.c_lock:
+            dict_job_type_book = dict(self.get_job_type_output_tables())
+
+        # 2. save to file
+        instrumentation.count("rows", sum(len(dict_sub_type) for dict_sub_type in dict_job_type_book.values()))
+        _write_job_type_output_sheet(file_path, dict_job_type_book, progress, cancel_event)
+
+    @instrumentation.stage("export_reports")
+    def export_reports(self, job_type_file: str = None, salary_file: str = None, workers: int = None,
+                       progress=None, cancel_event: threading.Event = None):
+        """
+        同时导出产量表和工资总表：所有员工的工作记录只收集一次，同时算出工资矩阵和产量表，
+        然后在两个进程中同时写出两个文件
+        :param job_type_file: 产量表文件，None表示不导出
+        :param salary_file: 工资总表文件，None表示不导出
+        :param workers: 写文件的进程数，默认为文件数和CPU核数中较小的，1表示在当前进程中依次写出
+        :param progress: 每写完产量表的一个表格或整个工资总表调用progress(done, total, item)
+        :param cancel_event: 被设置后在下一个表格之前抛出CancelledError，不保存任何文件
         :return:
         """
-        # 1. check if company is ready
-        self.log_debug("检查Company信息是否完整...10%")
-        if not self.my_company.c_dict_employee or not self.my_company.c_job_type_book:
-            tk.messagebox.showerror(title="ghSalaryCalc",message="尚未添加货品单价或员工信息")
-            return
+        # 1. one pass over the jobs for both reports
+        with self.c_lock:
+            df_jobs = self.get_job_table() if self.c_output_tables is None and job_type_file else None
+            df_salary = self.calc_salary_matrix(df_jobs).sort_index() if salary_file else None
+            dict_job_type_book = dict(self.get_job_type_output_tables(df_jobs)) if job_type_file else None
+        instrumentation.count("rows", (len(df_jobs) if df_jobs is not None else 0))
+
+        # 2. write both files at the same time into temporary files
+        list_task = []
+        for (file_path, func, data) in [(job_type_file, _write_job_type_output_sheet, dict_job_type_book),
+                                        (salary_file, _write_employee_salary_sheet, df_salary)]:
+            if file_path:
+                root, ext = os.path.splitext(file_path)
+                list_task.append((file_path, root + ".tmp" + ext, func, data))
+        if workers is None:
+            workers = min(len(list_task), os.cpu_count() or 1)
+        # progress of both files together, every sheet of the output tables and the salary sheet count one
+        list_total = [len(data) if func is _write_job_type_output_sheet else 1 for (_, _, func, data) in list_task]
+        list_done = [0] * len(list_task)
+
+        def task_progress(index: int, done: int, total: int, item):
+            list_done[index] = done
+            list_total[index] = total
+            if progress is not None:
+                progress(sum(list_done), sum(list_total), item)
 
-        # 2. check path valid
-        self.log_debug("检查输出路径是否有效...20%")
-        output_dir = os.getcwd()
-        # output_dir: str = self.entry_output_dir.get()
-        # if not os.path.exists(output_dir):
-        #     if tk.messagebox.askyesno(title="ghSalaryCalc",message="输出目录将设置为当前目录"):
-        #         output_dir = os.getcwd()
-        #     else:
-        #         return
-
-        # 3. export files
-        self.log_debug("正在导出常量信息...40%")
         try:
-            file_path = output_dir + os.sep + "每个款号总产量.xlsx"
-            if not os.path.exists(file_path) or \
-                    tk.messagebox.askyesno(title="ghSalaryCalc",message="是否覆盖原文件：%s" % file_path):
-                self.my_company.export_job_type_output_sheet(file_path)
-            self.log_debug("成功输出货品产量信息")
-        except Exception as e:
-            self.log_error(repr(e))
-            return
-
-        self.log_debug("正在导出工资信息...80%")
+            if workers > 1 and len(list_task) > 1:
+                self._write_reports_in_processes(list_task, min(workers, len(list_task)), task_progress, cancel_event)
+            else:
+                for (index, (_, tmp_path, func, data)) in enumerate(list_task):
+                    func(tmp_path, data, functools.partial(task_progress, index), cancel_event)
+            # 3. keep the files only when not cancelled
+            if cancel_event is not None and cancel_event.is_set():
+                raise CancelledError()
+        except BaseException:
+            for (_, tmp_path, _, _) in list_task:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            raise
+        for (file_path, tmp_path, _, _) in list_task:
+            os.replace(tmp_path, file_path)
+
+    @staticmethod
+    def _write_reports_in_processes(list_task: list, workers: int, task_progress,
+                                    cancel_event: threading.Event = None):
+        """
+        每个文件一个进程，等待时转发进度并检查cancel_event
+        """
+        context = multiprocessing.get_context()
+        process_cancel_event = context.Event()
+        progress_queue = context.Queue()
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_report_writer,
+                                       initargs=(process_cancel_event, progress_queue))
         try:
-            file_path = output_dir + os.sep + "员工工资总表.xlsx"
-            if not os.path.exists(file_path) or \
-                    tk.messagebox.askyesno(title="ghSalaryCalc",message="是否覆盖原文件：%s" % file_path):
-                self.my_company.export_employee_salary_sheet(file_path)
-            self.log_debug("成功输出员工工资信息")
-        except Exception as e:
-            self.log_error(repr(e))
-            return
-        self.log_debug("导出结束...100%")
-        tk.messagebox.showinfo(title="ghSalaryCalc", message="执行结束")
+            list_future = [executor.submit(_write_report, index, func, tmp_path, data)
+                           for (index, (_, tmp_path, func, data)) in enumerate(list_task)]
+            set_pending = set(list_future)
+            while True:
+                if cancel_event is not None and cancel_event.is_set():
+                    process_cancel_event.set()
+                try:
+                    while True:
+                        task_progress(*progress_queue.get_nowait())
+                except queue.Empty:
+                    pass
+                if not set_pending:
+                    break
+                _, set_pending = concurrent.futures.wait(set_pending, timeout=0.1)
+            for future in list_future:
+                future.result()
+        finally:
+            executor.shutdown()
+            progress_queue.close()
+
 
-    def handle_add_employees(self, excel_file_list: list):
+def _expand_employee_paths(list_pattern: list)->list:
+    """
+    展开命令行中的员工文件参数，可以是文件、目录或通配符
+    :param list_pattern: list of str
+    :return: 排序后的xls/xlsx文件列表
+    """
+    list_file = []
+    for pattern in list_pattern:
+        if os.path.isdir(pattern):
+            list_match = glob.glob(os.path.join(pattern, "*.xls")) + glob.glob(os.path.join(pattern, "*.xlsx"))
+        else:
+            list_match = glob.glob(pattern) or [pattern]
+        # skip excel lock files
+        list_file += sorted(_file for _file in list_match if not os.path.basename(_file).startswith("~$"))
+    return list_file
+
+
+def run_batch(price_book: str, list_employee_file: list, output_dir: str,
+              workers: int = None, cache_dir: str = None, overwrite: bool = False,
+              list_consolidated_file: list = (), history: str = None, period: str = None,
+              salary_formats: list = ("xlsx", ), job_type_formats: list = ("xlsx", ), lazy: bool = False)->int:
+    """
+    不启动界面，加载单价本和员工文件并导出两张表格
+    :param history: 历史数据库，不为None时把单价本和工作记录保存为period月的数据
+    :param salary_formats: 工资总表的导出格式，见EXPORT_FORMATS
+    :param job_type_formats: 产量表的导出格式，xlsx以外的格式导出get_long_table
+    :param lazy: 单价本只读取员工用到的款号
+    :return: exit code, 0 for success
+    """
+    _check_export_formats(list(salary_formats) + list(job_type_formats))
+    for (_, _, file_path) in _report_paths(output_dir, salary_formats, job_type_formats):
+        if os.path.exists(file_path) and not overwrite:
+            logging.error("输出文件已存在：%s，使用--overwrite覆盖" % file_path)
+            return 1
+    os.makedirs(output_dir, exist_ok=True)
+
+    company = Company()
+    if cache_dir is not None:
+        company.c_parse_cache = ParseCache(cache_dir)
+    company.c_job_type_book = JobTypeBook(file_path=price_book, cache=company.c_parse_cache, lazy=lazy)
+    logging.info("成功加载货品价格信息：%d个款号" % len(company.c_job_type_book.b_dict_job_types))
+
+    dict_error = company.load_employees(list_employee_file, workers=workers)
+    for _file in list_consolidated_file:
         try:
-            for _file in excel_file_list:
-                    logging.debug("select %s \n" % _file)
-                    # check file extension
-                    _file_ext = os.path.splitext(_file)[1]
-                    if _file_ext != ".xls" and _file_ext != ".xlsx":
-                        raise Exception("不支持的文件格式: %s" % _file_ext)
-
-                    workbook = xw.Book(_file)
-
-                    # check sheet names
-                    sheet_exist = False
-                    for sht in workbook.sheets:
-                        if sht.name == "员工产值明细":
-                            sheet_exist = True
-
-                    if not sheet_exist:
-                        raise Exception("员工文件%s里不包含表格‘员工产值明细’" % _file)
-
-                    # check sheet info
-                    first_line = workbook.sheets["员工产值明细"].range('A1:D1').value
-                    if first_line[0] != "员工：" or first_line[2] != "工号：":
-                        workbook.close()
-                        raise Exception("表格%s格式不正确")
-
-                    # add employee by sheet
-                    # TODO: maybe need many employees in one file
-                    self.my_company.add_employee(name=workbook.sheets["员工产值明细"].range("B1").value,
-                                                 eid=workbook.sheets["员工产值明细"].range("D1").value,
-                                                 file_path=_file)
-                    workbook.close()
-            self.log_debug("成功加载员工信息")
+            company.load_consolidated_file(_file)
         except Exception as e:
-            self.log_error(repr(e))
-        finally:
-            # Update UI info
-            text = ""
-            for (name, employee) in self.my_company.c_dict_employee.items():
-                text += name + " "
-            self.label_selected_employee["text"] = text
-
-    def handle_set_price(self, file_path: str):
+            dict_error[_file] = repr(e)
+    for (_file, message) in dict_error.items():
+        logging.error("%s: %s" % (_file, message))
+    logging.info("成功加载员工信息：%d个员工" % len(company.c_dict_employee))
+    if dict_error:
+        logging.error("%d个员工文件加载失败" % len(dict_error))
+        return 1
+
+    if not _log_validation(company.validate_jobs()):
+        return 1
+    _export_reports(company, output_dir, salary_formats, job_type_formats)
+    if history is not None:
+        store = HistoryStore(history)
         try:
-            work_book = xw.Book(file_path)
-            # check sheet names
-            sheet_exist = False
-            for sht in work_book.sheets:
-                if sht.name == "单价表":
-                    sheet_exist = True
+            store.save_job_type_book(company.c_job_type_book, period, source=os.path.abspath(price_book))
+            store.save_company(company, period)
+        finally:
+            store.close()
+        logging.info("成功保存%s的工作记录到%s" % (period, history))
+    return 0
 
-            if not sheet_exist:
-                raise Exception("文件%s里不包含表格‘单价表’" % file_path)
 
-            self.my_company.c_job_type_book = JobTypeBook(work_book.sheets["单价表"])
-            work_book.close()
-            self.log_debug("成功加载货品价格信息")
+def run_history_report(history: str, period_from: str, period_to: str, output_dir: str,
+                       overwrite: bool = False)->int:
+    """
+    从历史数据库导出几个月的员工工资总表，不读取任何工作簿
+    :return: exit code, 0 for success
+    """
+    file_path = os.path.join(output_dir, "员工工资总表_%s_%s.xlsx" % (period_from, period_to))
+    if os.path.exists(file_path) and not overwrite:
+        logging.error("输出文件已存在：%s，使用--overwrite覆盖" % file_path)
+        return 1
+    os.makedirs(output_dir, exist_ok=True)
+    store = HistoryStore(history)
+    try:
+        store.export_employee_salary_sheet(file_path, period_from, period_to)
+    finally:
+        store.close()
+    logging.info("成功输出员工工资信息：%s" % file_path)
+    return 0
+
+
+def _log_validation(df_problem: DataFrame)->bool:
+    """
+    输出检查结果，每个问题一行
+    :return: False表示有会导致导出失败的问题
+    """
+    n_error = 0
+    for (name, _file, job_type_id, sub_type_id, finish_count, problem) \
+            in df_problem.itertuples(index=False, name=None):
+        is_error = problem in VALIDATION_ERRORS
+        n_error += is_error
+        (logging.error if is_error else logging.warning)("%s %s: %s-%s 数量%s %s" % (
+            name, _file, job_type_id, sub_type_id, finish_count, problem))
+    if n_error:
+        logging.error("工作记录检查发现%d个错误，请修改后重新运行" % n_error)
+    return n_error == 0
+
+
+def _report_paths(output_dir: str, salary_formats: list = ("xlsx", ), job_type_formats: list = ("xlsx", ))->list:
+    """
+    :return: list of (kind, fmt, file_path), kind为"job_type"或"salary"
+    """
+    list_path = []
+    for (kind, file_name, list_fmt) in [("job_type", JOB_TYPE_OUTPUT_FILE, job_type_formats),
+                                        ("salary", EMPLOYEE_SALARY_FILE, salary_formats)]:
+        for fmt in list_fmt:
+            list_path.append((kind, fmt, os.path.join(output_dir, os.path.splitext(file_name)[0] + "." + fmt)))
+    return list_path
+
+
+def _export_reports(company: Company, output_dir: str,
+                    salary_formats: list = ("xlsx", ), job_type_formats: list = ("xlsx", )):
+    dict_xlsx = {}
+    for (kind, fmt, file_path) in _report_paths(output_dir, salary_formats, job_type_formats):
+        if fmt == "xlsx":
+            dict_xlsx[kind] = file_path
+        elif kind == "job_type":
+            company.export_long_table(file_path, fmt)
+            logging.info("成功输出货品产量信息：%s" % file_path)
+        else:
+            company.export_employee_salary_table(file_path, fmt)
+            logging.info("成功输出员工工资信息：%s" % file_path)
+    if dict_xlsx:
+        # both workbooks from one pass over the jobs, written at the same time
+        company.export_reports(dict_xlsx.get("job_type"), dict_xlsx.get("salary"))
+        for (kind, file_path) in dict_xlsx.items():
+            logging.info("%s：%s" % ("成功输出货品产量信息" if kind == "job_type" else "成功输出员工工资信息", file_path))
+
+
+def run_watch(price_book: str, employee_dir: str, output_dir: str,
+              workers: int = None, cache_dir: str = None, interval: float = 1.0,
+              salary_formats: list = ("xlsx", ), job_type_formats: list = ("xlsx", ), lazy: bool = False)->int:
+    """
+    监视员工文件目录，每次有文件变化时增量更新并重新导出两张表格，Ctrl+C结束
+    :return: exit code, 0 for success
+    """
+    _check_export_formats(list(salary_formats) + list(job_type_formats))
+    os.makedirs(output_dir, exist_ok=True)
+    company = Company()
+    if cache_dir is not None:
+        company.c_parse_cache = ParseCache(cache_dir)
+    company.c_job_type_book = JobTypeBook(file_path=price_book, cache=company.c_parse_cache, lazy=lazy)
+    logging.info("成功加载货品价格信息：%d个款号" % len(company.c_job_type_book.b_dict_job_types))
+
+    def on_change(list_changed: list, list_removed: list, dict_error: dict):
+        logging.info("文件变化：更新%d个，删除%d个" % (len(list_changed), len(list_removed)))
+        for (_file, message) in dict_error.items():
+            logging.error("%s: %s" % (_file, message))
+        try:
+            if _log_validation(company.validate_jobs()):
+                _export_reports(company, output_dir, salary_formats, job_type_formats)
         except Exception as e:
-            self.log_error(repr(e))
-        finally:
-            # print selected job types
-            text = ""
-            for (id, job_type) in self.my_company.c_job_type_book.b_dict_job_types.items():
-                text += str(id) + " "
-            self.label_selected_jobtypes["text"] = text
+            logging.error(repr(e))
 
-    def handle_output(self, output_dir: str):
-        return
+    try:
+        company.watch_directory(employee_dir, on_change=on_change, interval=interval, workers=workers)
+    except KeyboardInterrupt:
+        pass
+    return 0
 
-    def log_debug(self, message: str):
-        self.write_status(message)
 
-    def log_error(self, message: str):
-        self.write_status(message, True)
-        self.listbox_err_report.insert(0, message)
-        tk.messagebox.showerror(title="ghSalaryCalc",message=message)
-        logging.error(traceback.format_exc())
+def run_serve(price_book: str, list_employee_file: list, list_consolidated_file: list = (),
+              workers: int = None, cache_dir: str = None, port: int = 8765, lazy: bool = False)->int:
+    """
+    加载一次单价本和员工，然后在localhost上提供查询服务，Ctrl+C结束
+    :return: exit code, 0 for success
+    """
+    import salary_server
+    company = Company()
+    if cache_dir is not None:
+        company.c_parse_cache = ParseCache(cache_dir)
+    company.c_job_type_book = JobTypeBook(file_path=price_book, cache=company.c_parse_cache, lazy=lazy)
+    logging.info("成功加载货品价格信息：%d个款号" % len(company.c_job_type_book.b_dict_job_types))
+    dict_error = company.load_employees(list_employee_file, workers=workers)
+    for _file in list_consolidated_file:
+        try:
+            company.load_consolidated_file(_file)
+        except Exception as e:
+            dict_error[_file] = repr(e)
+    for (_file, message) in dict_error.items():
+        logging.error("%s: %s" % (_file, message))
+    logging.info("成功加载员工信息：%d个员工" % len(company.c_dict_employee))
+    salary_server.run_server(company, port=port)
+    return 0
 
-    def write_status(self, message:str, is_error:bool = False):
-        if is_error:
-            self.label_status["fg"] = "red"
-        else:
-            self.label_status["fg"] = "blue"
-        self.label_status["text"] = message
 
+def main(argv: list = None)->int:
+    """
+    不带参数时启动界面，否则以命令行批处理方式运行
+    """
+    parser = argparse.ArgumentParser(description="ghSalaryCalc")
+    parser.add_argument("--price-book", help="单价本文件，包含表格“单价表”")
+    parser.add_argument("--employees", nargs="+", default=[], help="员工文件、目录或通配符")
+    parser.add_argument("--consolidated", nargs="+", default=[], help="包含多个员工的汇总表文件")
+    parser.add_argument("--output-dir", default=os.getcwd(), help="输出目录，默认为当前目录")
+    parser.add_argument("--workers", type=int, default=None, help="读取员工文件的进程数，默认为CPU核数")
+    parser.add_argument("--cache-dir", default=None, help="解析结果缓存目录")
+    parser.add_argument("--overwrite", action="store_true", help="覆盖已存在的输出文件")
+    parser.add_argument("--watch", action="store_true",
+                        help="监视--employees目录，文件变化时增量更新并重新导出（总是覆盖输出文件）")
+    parser.add_argument("--interval", type=float, default=1.0, help="--watch的检查间隔（秒）")
+    parser.add_argument("--lazy-price-book", action="store_true",
+                        help="单价本只读取第1行，员工用到的款号才读取工序，适合包含多年款号的单价本")
+    parser.add_argument("--salary-formats", nargs="+", choices=EXPORT_FORMATS, default=["xlsx"],
+                        help="工资总表的导出格式，可以指定多个")
+    parser.add_argument("--job-type-formats", nargs="+", choices=EXPORT_FORMATS, default=["xlsx"],
+                        help="产量表的导出格式，xlsx以外为长表（款号, 工序, 员工, 工号, 数量, 金额）")
+    parser.add_argument("--serve", action="store_true", help="加载后在localhost上提供HTTP/JSON查询服务")
+    parser.add_argument("--port", type=int, default=8765, help="--serve的端口")
+    parser.add_argument("--history", default=None, help="历史数据库（SQLite），批处理结果按--period保存到这里")
+    parser.add_argument("--period", default=time.strftime("%Y-%m"), help="保存到历史数据库的月份YYYY-MM，默认为本月")
+    parser.add_argument("--history-report", nargs=2, metavar=("FROM", "TO"), default=None,
+                        help="从--history导出FROM到TO（YYYY-MM）各月的工资总和")
+    parser.add_argument("--stats", default=None, help="把各阶段的耗时和计数写入这个JSON文件")
+    parser.add_argument("--profile", default=None, help="用cProfile分析并把结果写入这个文件")
+    parser.add_argument("--trace-memory", action="store_true", help="统计各阶段的峰值内存（较慢）")
+    args = parser.parse_args(argv)
+
+    if args.price_book is None and not args.employees and not args.consolidated and args.history_report is None:
+        logging.basicConfig(filename='ghSalaryCalc.log', level=logging.DEBUG, format='%(asctime)s %(message)s')
+        import salary_gui
+        salary_gui.run_gui()
+        return 0
+
+    if args.history_report is not None and args.history is None:
+        parser.error("--history-report需要指定--history")
+    if args.serve and args.price_book is None:
+        parser.error("--serve需要指定--price-book")
+    if args.history_report is None and not args.serve \
+            and (args.price_book is None or not (args.employees or args.consolidated)):
+        parser.error("--price-book和--employees（或--consolidated）必须同时指定")
+    if args.watch and (len(args.employees) != 1 or not os.path.isdir(args.employees[0])):
+        parser.error("--watch时--employees必须是一个目录")
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    instrumentation.enable(trace_memory=args.trace_memory, profile=args.profile is not None)
+    try:
+        if args.history_report is not None:
+            return run_history_report(args.history, args.history_report[0], args.history_report[1],
+                                      args.output_dir, overwrite=args.overwrite)
+        if args.serve:
+            return run_serve(args.price_book, _expand_employee_paths(args.employees), args.consolidated,
+                             workers=args.workers, cache_dir=args.cache_dir, port=args.port, lazy=args.lazy_price_book)
+        if args.watch:
+            return run_watch(args.price_book, args.employees[0], args.output_dir,
+                             workers=args.workers, cache_dir=args.cache_dir, interval=args.interval,
+                             salary_formats=args.salary_formats, job_type_formats=args.job_type_formats,
+                             lazy=args.lazy_price_book)
+        return run_batch(args.price_book, _expand_employee_paths(args.employees), args.output_dir,
+                         workers=args.workers, cache_dir=args.cache_dir, overwrite=args.overwrite,
+                         list_consolidated_file=args.consolidated, history=args.history, period=args.period,
+                         salary_formats=args.salary_formats, job_type_formats=args.job_type_formats,
+                         lazy=args.lazy_price_book)
+    except Exception as e:
+        logging.error(repr(e))
+        return 1
+    finally:
+        instrumentation.log_report()
+        if args.stats is not None:
+            with open(args.stats, "w", encoding="utf-8") as f:
+                f.write(instrumentation.to_json())
+        if args.profile is not None:
+            instrumentation.dump_profile(args.profile)
 
 
 if __name__ == '__main__':
-    # init logger
-    logging.basicConfig(filename='ghSalaryCalc.log', level=logging.DEBUG, format='%(asctime)s %(message)s')
-    logging.info("ghSalaryCalc start\n")
-    root = tk.Tk()
-    app = Application(master=root)
-    app.mainloop()
-    logging.info("ghSalaryCalc end\n")
+    # run the imported module, not __main__, so that salary_server and salary_gui, which import
+    # salary_calc, share its classes and instrumentation
+    import salary_calc
+    sys.exit(salary_calc.main())
@@ -0,0 +1,376 @@
+import os
+import logging
+import tkinter as tk
+import tkinter.filedialog
+import tkinter.messagebox
+import tkinter.ttk
+import traceback
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from salary_calc import Company, JobTypeBook, ParseCache, JOB_TYPE_OUTPUT_FILE, EMPLOYEE_SALARY_FILE, \
+    VALIDATION_ERRORS, instrumentation
+
+
+class TaskRunner:
+    """
+    Run loads and exports on background threads, UI updates are queued back to the Tk main loop
+    Attr:
+        t_executor: thread pool running the tasks, so the price book and employees load concurrently
+        t_queue: callbacks waiting to run on the Tk main thread
+        t_cancel_event: set to ask the running tasks to stop
+        t_running: number of tasks not finished yet, only used on the Tk main thread
+    """
+    def __init__(self, widget: tk.Widget, workers: int = 2, poll_ms: int = 50):
+        self.t_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="t_Task")
+        self.t_queue = queue.Queue()
+        self.t_cancel_event = threading.Event()
+        self.t_running = 0
+        self._widget = widget
+        self._poll_ms = poll_ms
+        widget.after(poll_ms, self._poll)
+
+    def submit(self, func, args: tuple = (), on_done=None, on_error=None):
+        """
+        在后台线程执行func(*args)，结束后在Tk主线程调用on_done(result)或on_error(exception)
+        """
+        if self.t_running == 0:
+            self.t_cancel_event.clear()
+        self.t_running += 1
+        future = self.t_executor.submit(func, *args)
+        future.add_done_callback(lambda f: self.t_queue.put(lambda: self._finish(f, on_done, on_error)))
+
+    def call_in_ui(self, func, *args):
+        """
+        可以在任何线程调用，func会在Tk主线程执行
+        """
+        self.t_queue.put(lambda: func(*args))
+
+    def cancel(self):
+        self.t_cancel_event.set()
+
+    def shutdown(self):
+        self.t_cancel_event.set()
+        self.t_executor.shutdown(wait=False, cancel_futures=True)
+
+    def _finish(self, future, on_done, on_error):
+        self.t_running -= 1
+        try:
+            result = future.result()
+        except BaseException as e:
+            if on_error is not None:
+                on_error(e)
+            return
+        if on_done is not None:
+            on_done(result)
+
+    def _poll(self):
+        while True:
+            try:
+                callback = self.t_queue.get_nowait()
+            except queue.Empty:
+                break
+            callback()
+        self._widget.after(self._poll_ms, self._poll)
+
+
+class Application(tk.Frame):
+    btn_output: tk.Button
+    btn_cancel: tk.Button
+    btn_quit: tk.Button
+    btn_select_employee: tk.Button
+    btn_select_consolidated: tk.Button
+    btn_select_price: tk.Button
+    btn_show_employees: tk.Button
+    btn_show_job_types: tk.Button
+    label_selected_employee: tk.Label
+    label_selected_jobtypes: tk.Label
+    label_status: tk.Label
+    progress_bar: tk.ttk.Progressbar
+    listbox_err_report: tk.Listbox
+
+    def __init__(self, master=None):
+        super().__init__(master)
+        self.pack()
+        self.task_runner = TaskRunner(self)
+        self.create_widgets()
+        self.my_company: Company = Company()
+        self.my_company.c_parse_cache = ParseCache(os.path.join(os.getcwd(), "ghSalaryCalc.cache"))
+        self.master.protocol("WM_DELETE_WINDOW", self.btn_cmd_quit)
+
+    def create_widgets(self):
+        self.btn_output              = tk.Button(self, text="生成表格", command=self.btn_cmd_output, width=30)
+        self.btn_cancel              = tk.Button(self, text="取消", command=self.btn_cmd_cancel, state=tk.DISABLED)
+        self.btn_quit                = tk.Button(self, text="退出", command=self.btn_cmd_quit, width=10)
+        self.btn_select_employee     = tk.Button(self, text="加载员工", command=self.btn_cmd_add_employee)
+        self.btn_select_consolidated = tk.Button(self, text="加载汇总表", command=self.btn_cmd_add_consolidated)
+        self.btn_select_price        = tk.Button(self, text="加载价格", command=self.btn_cmd_select_price)
+        self.btn_show_employees      = tk.Button(self, text="...", command=self.btn_cmd_show_employees)
+        self.btn_show_job_types      = tk.Button(self, text="...", command=self.btn_cmd_show_job_types)
+        self.label_selected_employee = tk.Label(self, text="NA", width=20)
+        self.label_selected_jobtypes = tk.Label(self, text="NA", width=20)
+        self.label_status            = tk.Label(self, text="NA")
+        self.progress_bar            = tk.ttk.Progressbar(self, maximum=1.0, length=280)
+        self.listbox_err_report      = tk.Listbox(self, width=40)
+
+        self.btn_select_employee.grid(row=0, column=0)
+        self.label_selected_employee.grid(row=0, column=1, columnspan=2)
+        self.btn_show_employees.grid(row=0, column=3)
+        self.btn_select_consolidated.grid(row=0, column=4)
+
+        self.btn_select_price.grid(row=1, column=0)
+        self.label_selected_jobtypes.grid(row=1, column=1, columnspan=2)
+        self.btn_show_job_types.grid(row=1, column=3)
+
+        self.btn_output.grid(row=2, column=0, columnspan=3)
+        self.btn_cancel.grid(row=2, column=3)
+
+        self.label_status.grid(row=3, column=0, columnspan=2)
+        self.btn_quit.grid(row=3, column=2, columnspan=2)
+
+        self.progress_bar.grid(row=4, column=0, columnspan=4)
+        self.listbox_err_report.grid(row=5, column=0, columnspan=4)
+
+        self.log_debug("初始化成功")
+
+    def btn_cmd_add_employee(self):
+        """
+        添加员工按钮：添加到Company类中
+        :return:
+        """
+        list_file = tk.filedialog.askopenfilenames()
+        if len(list_file) != 0:
+            self.start_task(self.handle_add_employees, (list(list_file), ),
+                            on_done=self.on_employees_added)
+
+    def btn_cmd_add_consolidated(self):
+        """
+        加载汇总表按钮：一个文件包含多个员工的工作记录
+        :return:
+        """
+        file_selected = tk.filedialog.askopenfilename()
+        if file_selected != '':
+            self.start_task(self.handle_add_consolidated, (file_selected, ),
+                            on_done=self.on_consolidated_added)
+
+    def btn_cmd_select_price(self):
+        """
+        选择单价本按钮：添加到Company中
+        :return:
+        """
+        file_selected = tk.filedialog.askopenfilename()
+        if file_selected != '':
+            self.start_task(self.handle_set_price, (file_selected, ),
+                            on_done=self.on_price_set)
+
+    def btn_cmd_show_employees(self):
+        text = "已加载员工：\n"
+        line_ctrl_cnt = 0
+        with self.my_company.c_lock:
+            for (name, employee) in self.my_company.c_dict_employee.items():
+                text = text + name + " "
+                line_ctrl_cnt += 1
+                if not line_ctrl_cnt % 3:
+                    text += "\n"
+        tk.messagebox.showinfo(message=text)
+
+    def btn_cmd_show_job_types(self):
+        text = "已加载工项号：\n"
+        line_ctrl_cnt = 0
+        for id in self.my_company.c_job_type_book.b_dict_job_types.keys():
+            text = text + str(id) + " "
+            line_ctrl_cnt += 1
+            if not line_ctrl_cnt % 3:
+                text += "\n"
+        tk.messagebox.showinfo(message=text)
+
+    def btn_cmd_output(self):
+        """
+        程序执行按钮：产生输出文件
+        :return:
+        """
+        # 1. check if company is ready
+        self.log_debug("检查Company信息是否完整...")
+        if self.task_runner.t_running:
+            tk.messagebox.showerror(title="ghSalaryCalc",message="请等待加载完成")
+            return
+        if not self.my_company.c_dict_employee or not self.my_company.c_job_type_book:
+            tk.messagebox.showerror(title="ghSalaryCalc",message="尚未添加货品单价或员工信息")
+            return
+
+        # 2. check path valid
+        self.log_debug("检查输出路径是否有效...")
+        output_dir = os.getcwd()
+        # output_dir: str = self.entry_output_dir.get()
+        # if not os.path.exists(output_dir):
+        #     if tk.messagebox.askyesno(title="ghSalaryCalc",message="输出目录将设置为当前目录"):
+        #         output_dir = os.getcwd()
+        #     else:
+        #         return
+
+        # 3. ask before overwriting, then export files in background
+        list_output = []
+        for (file_name, kind) in [(JOB_TYPE_OUTPUT_FILE, "job_type"), (EMPLOYEE_SALARY_FILE, "salary")]:
+            file_path = output_dir + os.sep + file_name
+            if not os.path.exists(file_path) or \
+                    tk.messagebox.askyesno(title="ghSalaryCalc",message="是否覆盖原文件：%s" % file_path):
+                list_output.append((kind, file_path))
+        self.btn_output["state"] = tk.DISABLED
+        self.start_task(self.handle_output, (list_output, ), on_done=self.on_output_done)
+
+    def btn_cmd_cancel(self):
+        self.task_runner.cancel()
+        self.log_debug("正在取消...")
+
+    def btn_cmd_quit(self):
+        self.task_runner.shutdown()
+        self.master.destroy()
+
+    def start_task(self, func, args: tuple, on_done=None):
+        """
+        在后台执行func，界面不被阻塞，出错时在主线程显示错误
+        """
+        self.btn_cancel["state"] = tk.NORMAL
+        self.progress_bar["value"] = 0
+        self.task_runner.submit(func, args, on_done=lambda result: self.on_task_end(on_done, result),
+                                on_error=self.on_task_error)
+
+    def on_task_end(self, on_done, result):
+        if self.task_runner.t_running == 0:
+            self.btn_cancel["state"] = tk.DISABLED
+            self.btn_output["state"] = tk.NORMAL
+        if on_done is not None:
+            on_done(result)
+
+    def on_task_error(self, e: BaseException):
+        self.on_task_end(None, None)
+        if isinstance(e, CancelledError):
+            self.log_debug("已取消")
+        else:
+            self.log_error(repr(e), e)
+
+    def report_progress(self, text: str):
+        """
+        :return: 可以在后台线程调用的progress(done, total, item)
+        """
+        def progress(done: int, total: int, item):
+            self.task_runner.call_in_ui(self.show_progress,
+                                        "%s %d/%d %s" % (text, done, total, os.path.basename(str(item))),
+                                        done / total)
+        return progress
+
+    def show_progress(self, message: str, fraction: float):
+        self.write_status(message)
+        self.progress_bar["value"] = fraction
+
+    def handle_add_employees(self, excel_file_list: list)->dict:
+        """
+        后台线程：加载员工，不直接操作界面
+        """
+        return self.my_company.load_employees(excel_file_list, progress=self.report_progress("加载员工"),
+                                              cancel_event=self.task_runner.t_cancel_event)
+
+    def on_employees_added(self, dict_error: dict):
+        for (_file, message) in dict_error.items():
+            self.listbox_err_report.insert(0, "%s: %s" % (os.path.basename(_file), message))
+        if dict_error:
+            self.log_error("%d个员工文件加载失败" % len(dict_error))
+        elif self.task_runner.t_cancel_event.is_set():
+            self.log_debug("已取消，已加载%d个员工" % len(self.my_company.c_dict_employee))
+        else:
+            self.log_debug("成功加载员工信息")
+        # Update UI info
+        text = ""
+        with self.my_company.c_lock:
+            for (name, employee) in self.my_company.c_dict_employee.items():
+                text += name + " "
+        self.label_selected_employee["text"] = text
+
+    def handle_add_consolidated(self, file_path: str)->int:
+        """
+        后台线程：流式读取汇总表
+        """
+        self.task_runner.call_in_ui(self.show_progress, "正在读取汇总表%s..." % os.path.basename(file_path), 0)
+        return self.my_company.load_consolidated_file(file_path)
+
+    def on_consolidated_added(self, count: int):
+        self.on_employees_added({})
+        self.log_debug("成功从汇总表加载%d个员工" % count)
+        self.progress_bar["value"] = 1.0
+
+    def handle_set_price(self, file_path: str)->JobTypeBook:
+        """
+        后台线程：加载单价本，可以和加载员工同时进行
+        """
+        book = JobTypeBook(file_path=file_path, cache=self.my_company.c_parse_cache)
+        with self.my_company.c_lock:
+            self.my_company.c_job_type_book = book
+        return book
+
+    def on_price_set(self, book: JobTypeBook):
+        self.log_debug("成功加载货品价格信息")
+        # print selected job types
+        text = ""
+        for (id, job_type) in book.b_dict_job_types.items():
+            text += str(id) + " "
+        self.label_selected_jobtypes["text"] = text
+
+    def handle_output(self, list_output: list):
+        """
+        后台线程：先检查所有工作记录，没有错误时同时导出两个表格
+        :param list_output: list of (kind, file_path), kind为"job_type"或"salary"
+        :return: 检查结果，见Company.validate_jobs
+        """
+        self.task_runner.call_in_ui(self.show_progress, "正在检查工作记录...", 0)
+        df_problem = self.my_company.validate_jobs()
+        if df_problem["problem"].isin(VALIDATION_ERRORS).any():
+            return df_problem
+        if self.task_runner.t_cancel_event.is_set():
+            raise CancelledError()
+        dict_output = dict(list_output)
+        self.task_runner.call_in_ui(self.show_progress, "正在导出产量和工资信息...", 0)
+        self.my_company.export_reports(dict_output.get("job_type"), dict_output.get("salary"),
+                                       progress=self.report_progress("导出"),
+                                       cancel_event=self.task_runner.t_cancel_event)
+        self.task_runner.call_in_ui(self.show_progress, "成功输出货品产量和员工工资信息", 1.0)
+        return df_problem
+
+    def on_output_done(self, df_problem):
+        for (name, _file, job_type_id, sub_type_id, finish_count, problem) \
+                in df_problem.itertuples(index=False, name=None):
+            self.listbox_err_report.insert(tk.END, "%s %s-%s 数量%s %s" % (
+                name, job_type_id, sub_type_id, finish_count, problem))
+        n_error = df_problem["problem"].isin(VALIDATION_ERRORS).sum()
+        if n_error:
+            self.log_error("工作记录检查发现%d个错误，没有导出，请修改后重新加载" % n_error)
+            return
+        instrumentation.log_report()
+        self.log_debug("导出结束...100% " + instrumentation.summary())
+        tk.messagebox.showinfo(title="ghSalaryCalc", message="执行结束")
+
+    def log_debug(self, message: str):
+        self.write_status(message)
+
+    def log_error(self, message: str, e: BaseException = None):
+        self.write_status(message, True)
+        self.listbox_err_report.insert(0, message)
+        tk.messagebox.showerror(title="ghSalaryCalc",message=message)
+        if e is not None:
+            logging.error("".join(traceback.format_exception(type(e), e, e.__traceback__)))
+        else:
+            logging.error(message)
+
+    def write_status(self, message:str, is_error:bool = False):
+        if is_error:
+            self.label_status["fg"] = "red"
+        else:
+            self.label_status["fg"] = "blue"
+        self.label_status["text"] = message
+
+
+def run_gui():
+    logging.info("ghSalaryCalc start\n")
+    root = tk.Tk()
+    app = Application(master=root)
+    app.mainloop()
+    logging.info("ghSalaryCalc end\n")
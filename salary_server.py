@@ -0,0 +1,238 @@
+import json
+import logging
+import threading
+import numpy as np
+from pandas import DataFrame
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from salary_calc import Company, Employee, JOB_COLUMNS, instrumentation
+
+
+class SalaryService:
+    """
+    Answer salary and output queries from a company kept in memory
+    Attr:
+        s_company: the company, loaded once, jobs can be added while serving
+    Queries are answered from Company.get_cube, rebuilt only when the price book or any employee changes.
+    All access to the company goes through c_lock, so queries and uploads from many threads are safe.
+    """
+    GROUP_BY = ("employee", "job_type_id", "sub_type_id")
+
+    def __init__(self, company: Company):
+        self.s_company = company
+
+    def list_employees(self)->dict:
+        with self.s_company.c_lock:
+            return {"employees": [{"employee": name, "employee_id": employee.e_id}
+                                  for (name, employee) in self.s_company.c_dict_employee.items()]}
+
+    def list_job_types(self)->dict:
+        with self.s_company.c_lock:
+            return {"job_types": list(self.s_company.c_job_type_book.b_dict_job_types.keys())}
+
+    @instrumentation.stage("service_summary")
+    def summary(self, employee: str = None, employee_id: int = None, job_type_id: int = None,
+                sub_type_id: int = None, group_by: str = None)->dict:
+        """
+        工资和产量查询，参数为None表示不限制
+        :param group_by: None或GROUP_BY中的一项，按这一列分组列出
+        :return: {"finish_count", "amount", "unpriced", "rows"}, unpriced为单价本中没有单价的记录数，不计入amount
+        """
+        if group_by is not None and group_by not in self.GROUP_BY:
+            raise ValueError("group_by必须是%s之一" % "、".join(self.GROUP_BY))
+        df = self.s_company.get_cube().a_table
+        array_mask = np.ones(len(df), dtype=bool)
+        for (column, value) in [("employee", employee), ("employee_id", employee_id),
+                                ("job_type_id", job_type_id), ("sub_type_id", sub_type_id)]:
+            if value is not None:
+                array_mask &= (df[column] == value).to_numpy()
+        df = df[array_mask]
+        df = df.assign(amount=df["amount"].fillna(0.0))
+        instrumentation.count("rows", len(df))
+        result = {"finish_count": int(df["finish_count"].sum()), "amount": float(df["amount"].sum()),
+                  "unpriced": int(df["unpriced"].sum())}
+        if group_by is not None:
+            df_group = df.groupby(group_by, sort=True)[["finish_count", "amount", "unpriced"]].sum()
+            result["rows"] = [{group_by: _json_value(key), "finish_count": int(finish_count),
+                               "amount": float(amount), "unpriced": int(unpriced)}
+                              for (key, finish_count, amount, unpriced) in df_group.itertuples(name=None)]
+        return result
+
+    def rollup(self, by: list)->dict:
+        """
+        :return: {"rows": [{dimension..., "finish_count", "amount", "unpriced"}]}
+        """
+        df = self.s_company.get_cube().rollup(tuple(by)).reset_index()
+        return {"rows": _json_records(df[[column for column in df.columns if column != "index"]])}
+
+    def top(self, n: int, within: list, rank: str, measure: str)->dict:
+        if n < 0:
+            raise ValueError("n不能是负数")
+        return {"rows": _json_records(self.s_company.get_cube().top(n, tuple(within), rank, measure))}
+
+    @instrumentation.stage("service_add_jobs")
+    def add_jobs(self, name: str, eid: int, list_job: list)->dict:
+        """
+        上传工作记录，员工不存在时新建，已有的员工追加记录
+        :param list_job: list of [job_type_id, sub_type_id, finish_count]
+        :return: {"employee", "rows", "unknown"}, unknown为单价本中没有的(款号, 工序)
+        """
+        if not all(isinstance(job, list) and len(job) == 3 and all(_is_integer(value) for value in job)
+                   for job in list_job):
+            raise ValueError("jobs必须是[款号, 工序, 数量]的列表，都是整数")
+        try:
+            df_jobs = DataFrame(list_job, columns=JOB_COLUMNS, dtype=np.int64)
+        except OverflowError:
+            raise ValueError("jobs中的整数超出范围")
+        with self.s_company.c_lock:
+            employee = self.s_company.c_dict_employee.get(name)
+            if employee is None:
+                employee = Employee(name, eid)
+                employee.add_jobs(df_jobs)
+                self.s_company.set_employee(employee)
+            else:
+                employee.add_jobs(df_jobs)
+            _, array_valid = self.s_company.c_job_type_book.query_prices(df_jobs["job_type_id"].to_numpy(),
+                                                                         df_jobs["sub_type_id"].to_numpy())
+        instrumentation.count("rows", len(df_jobs))
+        return {"employee": name, "rows": len(df_jobs),
+                "unknown": df_jobs[~array_valid][["job_type_id", "sub_type_id"]].values.tolist()}
+
+
+def _is_integer(value)->bool:
+    """
+    JSON里的整数，12.0也算，12.7、true和"12"不算
+    """
+    if isinstance(value, bool):
+        return False
+    return isinstance(value, int) or (isinstance(value, float) and value.is_integer())
+
+
+def _json_value(value):
+    if isinstance(value, float) and value != value:
+        return None
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _json_records(df: DataFrame)->list:
+    return [{column: _json_value(value) for (column, value) in zip(df.columns, row)}
+            for row in df.itertuples(index=False, name=None)]
+
+
+class SalaryRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET  /health
+    GET  /employees
+    GET  /job_types
+    GET  /stats
+    GET  /summary?employee=&employee_id=&job_type_id=&sub_type_id=&group_by=
+    GET  /rollup?by=job_type_id,sub_type_id
+    GET  /top?n=5&within=job_type_id,sub_type_id&rank=employee&measure=finish_count
+    POST /jobs  {"employee": name, "employee_id": eid, "jobs": [[job_type_id, sub_type_id, finish_count], ...]}
+    """
+    service: SalaryService = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        dict_query = {key: list_value[-1] for (key, list_value) in parse_qs(url.query).items()}
+        try:
+            if url.path == "/health":
+                self._send(200, {"status": "ok"})
+            elif url.path == "/employees":
+                self._send(200, self.service.list_employees())
+            elif url.path == "/job_types":
+                self._send(200, self.service.list_job_types())
+            elif url.path == "/stats":
+                self._send(200, instrumentation.report())
+            elif url.path == "/summary":
+                self._send(200, self.service.summary(
+                    employee=dict_query.get("employee"),
+                    employee_id=_int_param(dict_query, "employee_id"),
+                    job_type_id=_int_param(dict_query, "job_type_id"),
+                    sub_type_id=_int_param(dict_query, "sub_type_id"),
+                    group_by=dict_query.get("group_by")))
+            elif url.path == "/rollup":
+                self._send(200, self.service.rollup(_list_param(dict_query, "by")))
+            elif url.path == "/top":
+                n = _int_param(dict_query, "n")
+                self._send(200, self.service.top(10 if n is None else n,
+                                                 _list_param(dict_query, "within", ["job_type_id", "sub_type_id"]),
+                                                 dict_query.get("rank", "employee"),
+                                                 dict_query.get("measure", "finish_count")))
+            else:
+                self._send(404, {"error": "未知路径%s" % url.path})
+        except ValueError as e:
+            self._send(400, {"error": str(e)})
+        except Exception as e:
+            logging.error("SalaryRequestHandler: %s %s\n" % (self.path, repr(e)))
+            self._send(500, {"error": repr(e)})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/jobs":
+            self._send(404, {"error": "未知路径%s" % url.path})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+            if not isinstance(body, dict) or not isinstance(body.get("employee"), str) \
+                    or not isinstance(body.get("jobs"), list):
+                raise ValueError("需要employee和jobs")
+            self._send(200, self.service.add_jobs(body["employee"], body.get("employee_id"), body["jobs"]))
+        except ValueError as e:
+            self._send(400, {"error": str(e)})
+        except Exception as e:
+            logging.error("SalaryRequestHandler: %s %s\n" % (self.path, repr(e)))
+            self._send(500, {"error": repr(e)})
+
+    def _send(self, status: int, result: dict):
+        data = json.dumps(result, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug("%s %s" % (self.address_string(), format % args))
+
+
+def _int_param(dict_query: dict, key: str)->int:
+    value = dict_query.get(key)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError("%s必须是整数" % key)
+
+
+def _list_param(dict_query: dict, key: str, default: list = ())->list:
+    value = dict_query.get(key)
+    if value is None:
+        return list(default)
+    return [item for item in value.split(",") if item]
+
+
+def make_server(company: Company, host: str = "127.0.0.1", port: int = 8765)->ThreadingHTTPServer:
+    """
+    :param port: 0表示由系统分配，实际端口为server.server_address[1]
+    :return: 还没有开始服务的server，调用serve_forever()开始
+    """
+    handler = type("BoundSalaryRequestHandler", (SalaryRequestHandler, ), {"service": SalaryService(company)})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def run_server(company: Company, host: str = "127.0.0.1", port: int = 8765, stop_event: threading.Event = None):
+    """
+    在当前线程服务直到Ctrl+C或stop_event被设置
+    """
+    server = make_server(company, host, port)
+    logging.info("查询服务已启动：http://%s:%d/" % server.server_address[:2])
+    if stop_event is not None:
+        threading.Thread(target=lambda: (stop_event.wait(), server.shutdown()), daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
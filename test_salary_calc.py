@@ -0,0 +1,789 @@
+import os
+import re
+import sys
+import json
+import shutil
+import subprocess
+import importlib.util
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import CancelledError
+import tempfile
+import tracemalloc
+import unittest
+import unittest.mock
+import openpyxl
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+from salary_calc import Company, Employee, Job, JobType, JobTypeBook, HistoryStore, ParseCache, Instrumentation, \
+    instrumentation, \
+    VALIDATION_ERRORS, VALIDATION_UNKNOWN_JOB_TYPE, VALIDATION_UNKNOWN_SUB_TYPE, VALIDATION_NO_PRICE, \
+    VALIDATION_NON_POSITIVE_COUNT, VALIDATION_DUPLICATE
+from salary_bench import make_price_book, make_employee_file
+from salary_server import make_server
+
+
+N_STYLES = 4
+N_OPERATIONS = 5
+UNKNOWN_JOB_TYPE_ID = 999999
+
+
+def baseline_salary_matrix(company: Company)->DataFrame:
+    """
+    最初的算法：逐个员工、逐个款号调用calc_employee_salary_in_job_type
+    """
+    list_job_type_id = list(company.c_job_type_book.b_dict_job_types.keys())
+    return DataFrame([[company.calc_employee_salary_in_job_type(name, job_type_id)
+                       for job_type_id in list_job_type_id]
+                      for name in company.c_dict_employee],
+                     index=list(company.c_dict_employee), columns=list_job_type_id)
+
+
+class SalaryTestCase(unittest.TestCase):
+    """
+    共用的测试数据：N_STYLES个款号、每个款号N_OPERATIONS道工序的单价本和3个员工文件
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.work_dir = tempfile.mkdtemp()
+        cls.price_book = os.path.join(cls.work_dir, "price_book.xlsx")
+        cls.list_job_id = make_price_book(cls.price_book, N_STYLES, N_OPERATIONS)
+        cls.employee_dir = os.path.join(cls.work_dir, "employees")
+        os.makedirs(cls.employee_dir)
+        cls.list_employee_file = []
+        for loop in range(3):
+            file_path = os.path.join(cls.employee_dir, "employee_%d.xlsx" % loop)
+            make_employee_file(file_path, "员工%d" % loop, loop, cls.list_job_id, N_OPERATIONS, 40, seed=loop)
+            cls.list_employee_file.append(file_path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.work_dir)
+
+    def make_company(self, list_file: list = None, workers: int = 1)->Company:
+        company = Company()
+        company.c_job_type_book = JobTypeBook(file_path=self.price_book)
+        dict_error = company.load_employees(self.list_employee_file if list_file is None else list_file,
+                                            workers=workers)
+        self.assertEqual(dict_error, {})
+        return company
+
+    def assert_same_salary(self, company: Company, expected: DataFrame = None):
+        """
+        calc_salary_matrix与最初的逐格计算完全相同
+        """
+        pd.testing.assert_frame_equal(company.calc_salary_matrix(),
+                                      baseline_salary_matrix(company) if expected is None else expected,
+                                      check_exact=True)
+
+
+class TestSalaryMatrix(SalaryTestCase):
+    def test_same_as_baseline(self):
+        self.assert_same_salary(self.make_company())
+
+    def test_unknown_job_type_is_unpaid(self):
+        company = self.make_company()
+        expected = baseline_salary_matrix(company)
+        company.c_dict_employee["员工0"].add_job(Job(UNKNOWN_JOB_TYPE_ID, 1, 100))
+        self.assertNotIn(UNKNOWN_JOB_TYPE_ID, company.calc_salary_matrix().columns)
+        self.assert_same_salary(company, expected)
+
+    def test_unknown_sub_type_raises(self):
+        company = self.make_company()
+        company.c_dict_employee["员工0"].add_job(Job(self.list_job_id[0], N_OPERATIONS + 1, 100))
+        with self.assertRaisesRegex(Exception, "所要求的货品ID无效"):
+            company.calc_salary_matrix()
+        with self.assertRaisesRegex(Exception, "所要求的货品ID无效"):
+            baseline_salary_matrix(company)
+
+    def test_duplicate_jobs_are_merged(self):
+        company = Company()
+        company.c_job_type_book = JobTypeBook(file_path=self.price_book)
+        employee = Employee("员工0", 0)
+        for _ in range(2):
+            employee.add_job(Job(self.list_job_id[0], 1, 10))
+        company.set_employee(employee)
+        self.assertEqual(len(employee.e_jobs), 1)
+        self.assertEqual(len(employee.e_duplicates), 1)
+        self.assertEqual(company.calc_salary_matrix().loc["员工0", self.list_job_id[0]],
+                         company.c_job_type_book.query_price_by_id(self.list_job_id[0], 1) * 20)
+
+
+def fresh_copy(company: Company)->Company:
+    """
+    同样的单价本和员工，没有任何缓存
+    """
+    fresh = Company()
+    fresh.c_job_type_book = company.c_job_type_book
+    for (name, employee) in company.c_dict_employee.items():
+        copy = Employee(name, employee.e_id)
+        copy.add_jobs(employee.e_jobs)
+        fresh.set_employee(copy)
+    return fresh
+
+
+class TestLazyJobTypeBook(SalaryTestCase):
+    """
+    lazy读取的单价本，无论从哪个入口读取了款号，价格索引都与一次读完的相同
+    """
+    def assert_same_prices(self, book: JobTypeBook):
+        eager = JobTypeBook(file_path=self.price_book)
+        job_ids = np.repeat(self.list_job_id, N_OPERATIONS + 1)
+        sub_ids = np.tile(np.arange(1, N_OPERATIONS + 2), len(self.list_job_id))
+        prices, valid = book.query_prices(job_ids, sub_ids)
+        eager_prices, eager_valid = eager.query_prices(job_ids, sub_ids)
+        np.testing.assert_array_equal(valid, eager_valid)
+        np.testing.assert_array_equal(prices, eager_prices)
+        for job_type_id in self.list_job_id:
+            self.assertEqual(book.query_price_by_id(job_type_id, 1), eager.query_price_by_id(job_type_id, 1))
+
+    def test_query_price_by_name(self):
+        book = JobTypeBook(file_path=self.price_book, lazy=True)
+        book.query_price_by_name(self.list_job_id[1], "工序1")
+        self.assertEqual(book.query_price_by_id(self.list_job_id[1], 1),
+                         JobTypeBook(file_path=self.price_book).query_price_by_id(self.list_job_id[1], 1))
+        self.assert_same_prices(book)
+
+    def test_items(self):
+        book = JobTypeBook(file_path=self.price_book, lazy=True)
+        self.assertEqual(len(list(book.b_dict_job_types.items())), N_STYLES)
+        self.assert_same_prices(book)
+
+    def test_values(self):
+        book = JobTypeBook(file_path=self.price_book, lazy=True)
+        self.assertEqual(len(list(book.b_dict_job_types.values())), N_STYLES)
+        self.assert_same_prices(book)
+
+    def test_saved_to_history(self):
+        book = JobTypeBook(file_path=self.price_book, lazy=True)
+        store = HistoryStore(":memory:")
+        try:
+            store.save_job_type_book(book, "2024-05")
+        finally:
+            store.close()
+        self.assert_same_prices(book)
+
+    def test_salary_matrix(self):
+        company = self.make_company()
+        company.c_job_type_book = JobTypeBook(file_path=self.price_book, lazy=True)
+        self.assert_same_salary(company)
+
+
+class TestIncremental(SalaryTestCase):
+    """
+    增量更新的工资行和产量表与重新计算的结果相同
+    """
+    def assert_same_as_fresh(self, company: Company):
+        fresh = fresh_copy(company)
+        pd.testing.assert_frame_equal(company.calc_salary_matrix(), fresh.calc_salary_matrix(), check_exact=True)
+        self.assertEqual([(job_type_id, list(dict_sub_type.items()))
+                          for (job_type_id, dict_sub_type) in company.get_job_type_output_tables().items()],
+                         [(job_type_id, list(dict_sub_type.items()))
+                          for (job_type_id, dict_sub_type) in fresh.get_job_type_output_tables().items()])
+
+    def make_primed_company(self)->Company:
+        company = self.make_company()
+        self.assert_same_as_fresh(company)
+        return company
+
+    def test_set_employee(self):
+        company = self.make_primed_company()
+        employee = Employee("员工9", 9)
+        employee.add_job(Job(self.list_job_id[-1], 1, 50))
+        company.set_employee(employee)
+        self.assert_same_as_fresh(company)
+
+    def test_replace_employee(self):
+        company = self.make_primed_company()
+        employee = Employee("员工1", 1)
+        employee.add_job(Job(self.list_job_id[0], 2, 30))
+        company.set_employee(employee)
+        self.assert_same_as_fresh(company)
+
+    def test_remove_employee(self):
+        company = self.make_primed_company()
+        company.remove_employee("员工1")
+        self.assertNotIn("员工1", company.calc_salary_matrix().index)
+        self.assert_same_as_fresh(company)
+
+    def test_set_price(self):
+        company = self.make_primed_company()
+        job_type_id = self.list_job_id[0]
+        before = company.calc_salary_matrix()
+        company.set_price(job_type_id, 1, 9.99)
+        self.assertEqual(company.c_job_type_book.query_price_by_id(job_type_id, 1), 9.99)
+        self.assert_same_as_fresh(company)
+        after = company.calc_salary_matrix()
+        pd.testing.assert_frame_equal(after.drop(columns=job_type_id), before.drop(columns=job_type_id))
+
+    def test_add_job_in_place(self):
+        company = self.make_primed_company()
+        company.c_dict_employee["员工0"].add_job(Job(self.list_job_id[1], 2, 7))
+        self.assert_same_as_fresh(company)
+        company.c_dict_employee["员工2"].add_job(Job(UNKNOWN_JOB_TYPE_ID, 1, 7))
+        self.assert_same_as_fresh(company)
+        self.assertIn(UNKNOWN_JOB_TYPE_ID, company.get_job_type_output_tables())
+
+    def test_scan_directory(self):
+        watch_dir = tempfile.mkdtemp(dir=self.work_dir)
+        for file_path in self.list_employee_file:
+            shutil.copy(file_path, watch_dir)
+        company = Company()
+        company.c_job_type_book = JobTypeBook(file_path=self.price_book)
+        snapshot, list_changed, list_removed, dict_error = company.scan_directory(watch_dir, workers=1)
+        self.assertEqual((len(list_changed), list_removed, dict_error), (3, [], {}))
+        self.assert_same_as_fresh(company)
+
+        # 1 a renamed file replaces its employee instead of adding another one
+        old_path = os.path.join(watch_dir, "employee_0.xlsx")
+        new_path = os.path.join(watch_dir, "renamed.xlsx")
+        os.rename(old_path, new_path)
+        snapshot, list_changed, list_removed, _ = company.scan_directory(watch_dir, snapshot, workers=1)
+        self.assertEqual((list_changed, list_removed), ([new_path], [old_path]))
+        self.assertEqual(sorted(company.c_dict_employee), ["员工0", "员工1", "员工2"])
+        self.assertEqual(company.c_dict_file_employee[new_path], "员工0")
+        self.assert_same_as_fresh(company)
+
+        # 2 a removed file removes its employee
+        os.remove(os.path.join(watch_dir, "employee_1.xlsx"))
+        snapshot, list_changed, list_removed, _ = company.scan_directory(watch_dir, snapshot, workers=1)
+        self.assertEqual(list_changed, [])
+        self.assertEqual(sorted(company.c_dict_employee), ["员工0", "员工2"])
+        self.assert_same_as_fresh(company)
+
+        # 3 nothing changed, nothing reloaded
+        _, list_changed, list_removed, _ = company.scan_directory(watch_dir, snapshot, workers=1)
+        self.assertEqual((list_changed, list_removed), ([], []))
+
+
+class TestValidation(SalaryTestCase):
+    def test_problems(self):
+        company = self.make_company()
+        employee = company.c_dict_employee["员工0"]
+        employee.add_job(Job(UNKNOWN_JOB_TYPE_ID, 1, 10))
+        employee.add_job(Job(self.list_job_id[0], N_OPERATIONS + 1, 10))
+        employee.add_job(Job(self.list_job_id[1], N_OPERATIONS, -100000))
+        df_problem = company.validate_jobs()
+        df_problem = df_problem[df_problem["problem"] != VALIDATION_DUPLICATE]
+        self.assertEqual(df_problem[["employee", "file", "job_type_id", "sub_type_id", "problem"]].values.tolist(),
+                         [["员工0", self.list_employee_file[0], UNKNOWN_JOB_TYPE_ID, 1, VALIDATION_UNKNOWN_JOB_TYPE],
+                          ["员工0", self.list_employee_file[0], self.list_job_id[0], N_OPERATIONS + 1,
+                           VALIDATION_UNKNOWN_SUB_TYPE],
+                          ["员工0", self.list_employee_file[0], self.list_job_id[1], N_OPERATIONS,
+                           VALIDATION_NON_POSITIVE_COUNT]])
+        self.assertEqual(df_problem["problem"].isin(VALIDATION_ERRORS).tolist(), [False, True, False])
+
+    def test_non_positive_count_does_not_block(self):
+        company = self.make_company()
+        employee = Employee("员工9", 9)
+        employee.add_job(Job(self.list_job_id[1], 1, 0))
+        employee.add_job(Job(self.list_job_id[1], 2, -5))
+        company.set_employee(employee)
+        df_problem = company.validate_jobs()
+        self.assertEqual((df_problem["problem"] == VALIDATION_NON_POSITIVE_COUNT).sum(), 2)
+        self.assertFalse(df_problem["problem"].isin(VALIDATION_ERRORS).any())
+        self.assert_same_salary(company)
+
+    def test_price_not_a_number(self):
+        company = self.make_company()
+        job_type = JobType(UNKNOWN_JOB_TYPE_ID)
+        job_type.add_sub_type(1, "空单价", None)
+        job_type.add_sub_type(2, "文字单价", "面议")
+        job_type.add_sub_type(3, "单价", 0.5)
+        company.c_job_type_book.add_job_type(job_type)
+        employee = Employee("员工9", 9)
+        for sub_type_id in (1, 2, 3):
+            employee.add_job(Job(UNKNOWN_JOB_TYPE_ID, sub_type_id, 10))
+        company.set_employee(employee)
+        df_problem = company.validate_jobs()
+        df_problem = df_problem[df_problem["problem"] != VALIDATION_DUPLICATE]
+        self.assertEqual(df_problem[["employee", "sub_type_id", "problem"]].values.tolist(),
+                         [["员工9", 1, VALIDATION_NO_PRICE], ["员工9", 2, VALIDATION_NO_PRICE]])
+        self.assertTrue(df_problem["problem"].isin(VALIDATION_ERRORS).all())
+        for sub_type_id in (1, 2):
+            with self.assertRaisesRegex(Exception, "所要求的货品ID无效"):
+                company.c_job_type_book.query_price_by_id(UNKNOWN_JOB_TYPE_ID, sub_type_id)
+        with self.assertRaisesRegex(Exception, "所要求的货品ID无效"):
+            company.calc_salary_matrix()
+
+        # 1 a price filled in later makes the record valid
+        company.set_price(UNKNOWN_JOB_TYPE_ID, 1, 0.25)
+        company.set_price(UNKNOWN_JOB_TYPE_ID, 2, 0.75)
+        self.assertFalse(company.validate_jobs()["problem"].isin(VALIDATION_ERRORS).any())
+        self.assertEqual(company.calc_salary_matrix().loc["员工9", UNKNOWN_JOB_TYPE_ID], 15.0)
+
+
+class TestExportReports(SalaryTestCase):
+    def export(self, company: Company, workers: int, progress=None, cancel_event: threading.Event = None)->tuple:
+        output_dir = tempfile.mkdtemp(dir=self.work_dir)
+        job_type_file = os.path.join(output_dir, "job_type.xlsx")
+        salary_file = os.path.join(output_dir, "salary.xlsx")
+        company.export_reports(job_type_file, salary_file, workers=workers, progress=progress,
+                               cancel_event=cancel_event)
+        return job_type_file, salary_file
+
+    def test_same_as_separate_exports(self):
+        company = self.make_company()
+        for workers in (1, 2):
+            list_progress = []
+            job_type_file, salary_file = self.export(company, workers,
+                                                     lambda done, total, item: list_progress.append((done, total)))
+            pd.testing.assert_frame_equal(pd.read_excel(salary_file, index_col=0),
+                                          company.calc_salary_matrix().sort_index(), check_names=False)
+            work_book = openpyxl.load_workbook(job_type_file, read_only=True)
+            dict_job_type_book = company.get_job_type_output_tables()
+            self.assertEqual(work_book.sheetnames, [str(job_type_id) for job_type_id in dict_job_type_book])
+            for (job_type_id, dict_sub_type) in dict_job_type_book.items():
+                list_row = [list(row) for row in work_book[str(job_type_id)].iter_rows(min_row=2, values_only=True)]
+                self.assertEqual([row[:len(expected)] for (row, expected) in zip(list_row, dict_sub_type.values())],
+                                 list(dict_sub_type.values()))
+            work_book.close()
+            self.assertTrue(list_progress)
+            self.assertTrue(all(total == len(dict_job_type_book) + 1 for (_, total) in list_progress))
+            if workers == 1:
+                self.assertEqual(list_progress[-1], (len(dict_job_type_book) + 1, len(dict_job_type_book) + 1))
+
+    def test_cancel_while_writing(self):
+        company = self.make_company()
+        cancel_event = threading.Event()
+        list_progress = []
+
+        def progress(done: int, total: int, item):
+            list_progress.append(done)
+            cancel_event.set()
+
+        with self.assertRaises(CancelledError):
+            self.export(company, 1, progress, cancel_event)
+        self.assertEqual(list_progress, [1])
+
+    def test_cancel_in_processes(self):
+        company = self.make_company()
+        cancel_event = threading.Event()
+        cancel_event.set()
+        output_dir = tempfile.mkdtemp(dir=self.work_dir)
+        with self.assertRaises(CancelledError):
+            company.export_reports(os.path.join(output_dir, "job_type.xlsx"), os.path.join(output_dir, "salary.xlsx"),
+                                   workers=2, cancel_event=cancel_event)
+        self.assertEqual(os.listdir(output_dir), [])
+
+
+class TestEmployeeFile(SalaryTestCase):
+    def make_employee_file(self, list_row: list)->str:
+        file_path = os.path.join(self.work_dir, "employee_9.xlsx")
+        work_book = openpyxl.Workbook()
+        work_sheet = work_book.active
+        work_sheet.title = "员工产值明细"
+        work_sheet.append(["员工：", "员工9", "工号：", 9])
+        work_sheet.append(["款号", "工序", "数量"])
+        for row in list_row:
+            work_sheet.append(row)
+        work_book.save(file_path)
+        return file_path
+
+    def test_integer_cells(self):
+        job_type_id = self.list_job_id[0]
+        file_path = self.make_employee_file([[job_type_id, 1, 10], [float(job_type_id), 2.0, "20"],
+                                             ["小计", None, 30]])
+        company = self.make_company([file_path])
+        self.assertEqual(company.c_dict_employee["员工9"].e_jobs.values.tolist(),
+                         [[job_type_id, 1, 10], [job_type_id, 2, 20]])
+
+    def test_non_integer_cells(self):
+        job_type_id = self.list_job_id[0]
+        for cell in (12.7, 2.9, True):
+            file_path = self.make_employee_file([[job_type_id, 1, 10], [job_type_id, 2, cell]])
+            company = Company()
+            company.c_job_type_book = JobTypeBook(file_path=self.price_book)
+            dict_error = company.load_employees([file_path], workers=1)
+            self.assertRegex(dict_error[file_path], "第4行格式不正确")
+            self.assertEqual(company.c_dict_employee, {})
+
+
+class TestParseCache(SalaryTestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(dir=self.work_dir)
+        self.file_dir = tempfile.mkdtemp(dir=self.work_dir)
+        self.list_file = []
+        for file_path in self.list_employee_file:
+            self.list_file.append(shutil.copy(file_path, self.file_dir))
+
+    def load(self, cache: ParseCache)->tuple:
+        """
+        :return: (company, 缓存命中的文件数)
+        """
+        instrumentation.reset()
+        company = Company()
+        company.c_parse_cache = cache
+        company.c_job_type_book = JobTypeBook(file_path=self.price_book, cache=cache)
+        self.assertEqual(company.load_employees(self.list_file, workers=1), {})
+        return company, instrumentation.report()["stages"]["load_employees"].get("cache_hits", 0)
+
+    def test_hit_after_reload(self):
+        company, cache_hits = self.load(ParseCache(self.cache_dir))
+        self.assertEqual(cache_hits, 0)
+        self.assertEqual(len(os.listdir(self.cache_dir)), len(self.list_file) + 1)
+        cached_company, cache_hits = self.load(ParseCache(self.cache_dir))
+        self.assertEqual(cache_hits, len(self.list_file))
+        np.testing.assert_array_equal(cached_company.c_job_type_book.b_price_matrix,
+                                      company.c_job_type_book.b_price_matrix)
+        pd.testing.assert_frame_equal(cached_company.calc_salary_matrix(), company.calc_salary_matrix(),
+                                      check_exact=True)
+
+    def test_miss_after_change(self):
+        self.load(ParseCache(self.cache_dir))
+        # 1 a new mtime misses
+        stat = os.stat(self.list_file[0])
+        os.utime(self.list_file[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        _, cache_hits = self.load(ParseCache(self.cache_dir))
+        self.assertEqual(cache_hits, len(self.list_file) - 1)
+
+        # 2 a new size misses, and the new jobs replace the old entry
+        make_employee_file(self.list_file[1], "员工1", 1, self.list_job_id, N_OPERATIONS, 5, seed=9)
+        company, cache_hits = self.load(ParseCache(self.cache_dir))
+        self.assertEqual(cache_hits, len(self.list_file) - 1)
+        pd.testing.assert_frame_equal(company.c_dict_employee["员工1"].e_jobs,
+                                      self.make_company([self.list_file[1]]).c_dict_employee["员工1"].e_jobs)
+        self.assertEqual(len(os.listdir(self.cache_dir)), len(self.list_file) + 1)
+
+    def test_invalidate_file(self):
+        cache = ParseCache(self.cache_dir)
+        self.load(cache)
+        cache.invalidate(self.list_file[0])
+        self.assertIsNone(cache.load_employee(self.list_file[0]))
+        self.assertIsNotNone(cache.load_employee(self.list_file[1]))
+        self.assertIsNotNone(cache.load_job_type_book(self.price_book))
+        cache.invalidate()
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_evict_once_per_batch(self):
+        cache = ParseCache(self.cache_dir)
+        self.load(cache)
+        total_bytes = sum(os.path.getsize(os.path.join(self.cache_dir, entry)) for entry in os.listdir(self.cache_dir))
+        shutil.rmtree(self.cache_dir)
+        small_cache = ParseCache(self.cache_dir, max_bytes=total_bytes - 1)
+        with unittest.mock.patch("salary_calc.os.listdir", wraps=os.listdir) as listdir:
+            self.load(small_cache)
+        # 1 saving does not scan the cache directory, the price book and the batch of employees evict once each
+        self.assertEqual(listdir.call_count, 2)
+        list_entry = os.listdir(self.cache_dir)
+        self.assertEqual(len(list_entry), len(self.list_file))
+        self.assertLessEqual(sum(os.path.getsize(os.path.join(self.cache_dir, entry)) for entry in list_entry),
+                             small_cache.p_max_bytes)
+
+
+class TestExportTable(SalaryTestCase):
+    def salary_from_long_table(self, company: Company, df_long: DataFrame)->DataFrame:
+        """
+        从长表重新汇总出工资表
+        """
+        df = df_long.groupby(["employee", "job_type_id"])["amount"].sum().unstack(fill_value=0.0)
+        df = df.reindex(index=list(company.c_dict_employee), columns=list(company.c_job_type_book.b_dict_job_types),
+                        fill_value=0.0)
+        df.index.name = None
+        df.columns.name = None
+        return df
+
+    def export_and_read(self, company: Company, fmt: str)->DataFrame:
+        file_path = os.path.join(tempfile.mkdtemp(dir=self.work_dir), "long_table." + fmt)
+        company.export_long_table(file_path, fmt)
+        if fmt == "csv":
+            with open(file_path, "rb") as f:
+                self.assertEqual(f.read(3), b"\xef\xbb\xbf")
+            return pd.read_csv(file_path, encoding="utf-8-sig")
+        return pd.read_parquet(file_path)
+
+    def assert_round_trip(self, fmt: str):
+        company = self.make_company()
+        company.c_dict_employee["员工0"].add_job(Job(UNKNOWN_JOB_TYPE_ID, 1, 7))
+        df_long = self.export_and_read(company, fmt)
+        self.assertEqual(list(df_long.columns),
+                         ["job_type_id", "sub_type_id", "employee", "employee_id", "finish_count", "amount"])
+        self.assertEqual(sorted(df_long["employee"].unique()), sorted(company.c_dict_employee))
+        self.assertEqual(df_long["amount"].isna().sum(), 1)
+        pd.testing.assert_frame_equal(self.salary_from_long_table(company, df_long), company.calc_salary_matrix())
+
+    def test_csv_round_trip(self):
+        self.assert_round_trip("csv")
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "需要pyarrow")
+    def test_parquet_round_trip(self):
+        self.assert_round_trip("parquet")
+
+
+class TestConsolidated(SalaryTestCase):
+    def make_consolidated_file(self, header: list, list_row: list)->str:
+        file_path = os.path.join(self.work_dir, "consolidated.xlsx")
+        work_book = openpyxl.Workbook()
+        work_sheet = work_book.active
+        work_sheet.append(header)
+        for row in list_row:
+            work_sheet.append(row)
+        work_book.save(file_path)
+        return file_path
+
+    def test_names_and_ids(self):
+        job_type_id = self.list_job_id[0]
+        file_path = self.make_consolidated_file(["员工", "工号", "款号", "工序", "数量"],
+                                                [["张三", 1, job_type_id, 1, 10], ["李四", 2, job_type_id, 2, 20],
+                                                 ["张三", 1, job_type_id, 1, 5], ["小计", None, None, None, 35]])
+        company = Company()
+        company.c_job_type_book = JobTypeBook(file_path=self.price_book)
+        self.assertEqual(company.load_consolidated_file(file_path), 2)
+        self.assertEqual(company.c_dict_employee["张三"].e_jobs.values.tolist(), [[job_type_id, 1, 15]])
+        self.assertEqual(company.c_dict_employee["李四"].e_id, 2)
+
+    def test_only_employee_id(self):
+        job_type_id = self.list_job_id[0]
+        file_path = self.make_consolidated_file(["工号", "款号", "工序", "数量"],
+                                                [[7, job_type_id, 1, 10], [8, job_type_id, 2, 20]])
+        company = Company()
+        company.c_job_type_book = JobTypeBook(file_path=self.price_book)
+        company.load_consolidated_file(file_path)
+        self.assertEqual(list(company.c_dict_employee), ["7", "8"])
+        self.assertEqual(company.c_dict_employee["7"].e_id, 7)
+        self.assertEqual(" ".join(company.c_dict_employee), "7 8")
+
+    def test_non_integer_cells(self):
+        job_type_id = self.list_job_id[0]
+        for cell in (12.7, 2.9, True):
+            file_path = self.make_consolidated_file(["员工", "款号", "工序", "数量"],
+                                                    [["张三", job_type_id, 1, 10.0], ["李四", job_type_id, 2, cell]])
+            company = Company()
+            company.c_job_type_book = JobTypeBook(file_path=self.price_book)
+            with self.assertRaisesRegex(Exception, "第3行格式不正确"):
+                company.load_consolidated_file(file_path)
+
+
+class TestHistoryStore(SalaryTestCase):
+    def setUp(self):
+        self.store = HistoryStore(":memory:")
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_salary_matrix_same_as_company(self):
+        company = self.make_company()
+        self.store.save_job_type_book(company.c_job_type_book, "2024-05")
+        self.store.save_company(company, "2024-05")
+        pd.testing.assert_frame_equal(self.store.query_salary_matrix("2024-05", "2024-05"),
+                                      company.calc_salary_matrix().sort_index(), check_exact=True)
+
+    def test_unchanged_book_keeps_version(self):
+        book = JobTypeBook(file_path=self.price_book)
+        version = self.store.save_job_type_book(book, "2024-05")
+        self.assertEqual(self.store.save_job_type_book(JobTypeBook(file_path=self.price_book), "2024-05"), version)
+        book.set_price(self.list_job_id[0], 1, 9.99)
+        new_version = self.store.save_job_type_book(book, "2024-05")
+        self.assertNotEqual(new_version, version)
+        self.assertEqual(self.store.get_price_version("2024-05"), new_version)
+        self.assertEqual(self.store.load_job_type_book(new_version).query_price_by_id(self.list_job_id[0], 1), 9.99)
+        self.assertNotEqual(self.store.save_job_type_book(book, "2024-06"), new_version)
+
+
+class TestCube(SalaryTestCase):
+    def make_company_with_unpriced(self)->Company:
+        company = self.make_company()
+        company.c_dict_employee["员工0"].add_job(Job(UNKNOWN_JOB_TYPE_ID, 1, 7))
+        company.c_dict_employee["员工1"].add_job(Job(UNKNOWN_JOB_TYPE_ID, 2, 3))
+        return company
+
+    @staticmethod
+    def direct_rollup(company: Company, by: list)->DataFrame:
+        """
+        不经过缓存，直接从长表汇总
+        """
+        df = company.get_long_table()
+        return df.assign(unpriced=df["amount"].isna().astype(np.int64)).groupby(by, sort=True)[
+            ["finish_count", "amount", "unpriced"]].sum()
+
+    def test_rollup_from_cached_rollup(self):
+        company = self.make_company_with_unpriced()
+        cube = company.get_cube()
+        cube.rollup(("employee", "job_type_id", "sub_type_id"))
+        cube.rollup(("employee", "job_type_id"))
+        for by in (["employee"], ["job_type_id"], ["sub_type_id"], ["employee", "job_type_id"]):
+            pd.testing.assert_frame_equal(cube.rollup(tuple(by)), self.direct_rollup(company, by))
+        df_total = cube.rollup(())
+        self.assertEqual(df_total["unpriced"].tolist(), [2])
+        self.assertEqual(df_total["finish_count"].tolist(), [company.get_long_table()["finish_count"].sum()])
+        self.assertAlmostEqual(df_total["amount"].iloc[0], company.calc_salary_matrix().values.sum())
+        self.assertEqual(cube.rollup(("employee", ))["unpriced"].to_dict(), {"员工0": 1, "员工1": 1, "员工2": 0})
+
+    def test_top(self):
+        company = self.make_company_with_unpriced()
+        df_top = company.get_cube().top(2, ("job_type_id", ), "employee", "finish_count")
+        df_expected = self.direct_rollup(company, ["job_type_id", "employee"]).reset_index()
+        df_expected = df_expected.sort_values(["job_type_id", "finish_count", "employee"],
+                                              ascending=[True, False, True]).groupby("job_type_id").head(2)
+        pd.testing.assert_frame_equal(df_top, df_expected.reset_index(drop=True))
+        self.assertTrue((df_top.groupby("job_type_id").size() <= 2).all())
+        df_top = company.get_cube().top(1, (), "employee", "unpriced")
+        self.assertEqual(df_top[["employee", "unpriced"]].values.tolist(), [["员工0", 1]])
+
+    def test_add_job_invalidates_cube(self):
+        company = self.make_company()
+        cube = company.get_cube()
+        before = cube.rollup(("employee", )).loc["员工2"].tolist()
+        self.assertIs(company.get_cube(), cube)
+        company.c_dict_employee["员工2"].add_job(Job(self.list_job_id[0], 1, 5))
+        self.assertIsNot(company.get_cube(), cube)
+        after = company.get_cube().rollup(("employee", )).loc["员工2"].tolist()
+        self.assertEqual(after[0], before[0] + 5)
+        price = company.c_job_type_book.query_price_by_id(self.list_job_id[0], 1)
+        self.assertAlmostEqual(after[1], before[1] + 5 * price)
+        pd.testing.assert_frame_equal(company.get_cube().rollup(("employee", )),
+                                      self.direct_rollup(company, ["employee"]))
+
+
+class TestInstrumentation(SalaryTestCase):
+    def load_counters(self, workers: int)->dict:
+        """
+        :return: 每个阶段除用时外的统计
+        """
+        instrumentation.reset()
+        self.make_company(workers=workers).calc_salary_matrix()
+        return {name: {counter: n for (counter, n) in stats.items() if counter != "wall_time"}
+                for (name, stats) in instrumentation.report()["stages"].items()}
+
+    def test_workers_report_same_counters(self):
+        dict_stage = self.load_counters(workers=1)
+        self.assertEqual(dict_stage["load_jobs_from_file"]["calls"], len(self.list_employee_file))
+        self.assertEqual(dict_stage["load_jobs_from_file"]["rows"], 40 * len(self.list_employee_file))
+        self.assertGreater(dict_stage["load_jobs_from_file"]["duplicate_merges"], 0)
+        self.assertEqual(self.load_counters(workers=2), dict_stage)
+
+    def test_nested_stage_keeps_outer_peak(self):
+        """
+        内层阶段重置tracemalloc的峰值前，外层阶段已达到的峰值不会丢失
+        """
+        stats = Instrumentation()
+
+        @stats.stage("inner")
+        def inner():
+            return len(bytearray(1 << 10))
+
+        @stats.stage("outer")
+        def outer():
+            block = bytearray(8 << 20)
+            del block
+            inner()
+
+        was_tracing = tracemalloc.is_tracing()
+        stats.enable(trace_memory=True)
+        try:
+            outer()
+        finally:
+            if not was_tracing:
+                tracemalloc.stop()
+        dict_stage = stats.report()["stages"]
+        self.assertGreaterEqual(dict_stage["outer"]["peak_memory"], 8 << 20)
+        self.assertLess(dict_stage["inner"]["peak_memory"], 8 << 20)
+
+
+class TestServe(SalaryTestCase):
+    def test_stats_include_all_stages(self):
+        """
+        python salary_calc.py --serve时，/stats包含加载和查询的所有阶段
+        """
+        process = subprocess.Popen([sys.executable, "salary_calc.py", "--serve", "--port", "0", "--workers", "1",
+                                    "--price-book", self.price_book, "--employees", self.employee_dir],
+                                   cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   stderr=subprocess.PIPE, text=True, encoding="utf-8")
+        try:
+            for line in process.stderr:
+                match = re.search(r"http://([0-9.]+):(\d+)/", line)
+                if match:
+                    break
+            self.assertIsNotNone(match)
+            url = "http://%s:%s" % match.groups()
+            with urllib.request.urlopen(url + "/summary?group_by=employee") as response:
+                self.assertEqual(len(json.loads(response.read())["rows"]), len(self.list_employee_file))
+            with urllib.request.urlopen(url + "/stats") as response:
+                dict_stage = json.loads(response.read())["stages"]
+            for stage in ("job_type_book", "load_employees", "load_jobs_from_file", "get_cube", "service_summary"):
+                self.assertIn(stage, dict_stage)
+        finally:
+            process.terminate()
+            process.wait()
+            process.stderr.close()
+
+
+class TestServer(SalaryTestCase):
+    """
+    make_server(port=0)在本进程中服务，上传和查询可以同时进行
+    """
+    def setUp(self):
+        self.company = self.make_company()
+        self.server = make_server(self.company, port=0)
+        self.url = "http://%s:%d" % self.server.server_address[:2]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def request(self, path: str, body: dict = None)->tuple:
+        """
+        :return: (status, 返回的json)
+        """
+        data = None if body is None else json.dumps(body).encode("utf-8")
+        try:
+            with urllib.request.urlopen(urllib.request.Request(self.url + path, data=data)) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            with e:
+                return e.code, json.loads(e.read())
+
+    def test_post_jobs(self):
+        job_type_id = self.list_job_id[0]
+        status, result = self.request("/jobs", {"employee": "员工9", "employee_id": 9,
+                                                "jobs": [[job_type_id, 1, 10], [job_type_id, 2, 20.0],
+                                                         [UNKNOWN_JOB_TYPE_ID, 1, 5]]})
+        self.assertEqual((status, result["rows"], result["unknown"]), (200, 3, [[UNKNOWN_JOB_TYPE_ID, 1]]))
+        self.assertEqual(self.company.c_dict_employee["员工9"].e_jobs.values.tolist(),
+                         [[job_type_id, 1, 10], [job_type_id, 2, 20], [UNKNOWN_JOB_TYPE_ID, 1, 5]])
+        status, result = self.request("/summary?employee=%E5%91%98%E5%B7%A59")
+        self.assertEqual((status, result["finish_count"], result["unpriced"]), (200, 35, 1))
+
+    def test_reject_bad_jobs(self):
+        job_type_id = self.list_job_id[0]
+        for job in ([job_type_id, 1, 12.7], [job_type_id, 1, True], [job_type_id, 1, "12"], [job_type_id, 1],
+                    [job_type_id, 1, 2 ** 70]):
+            status, result = self.request("/jobs", {"employee": "员工9", "jobs": [job]})
+            self.assertEqual(status, 400, job)
+        self.assertNotIn("员工9", self.company.c_dict_employee)
+        self.assertEqual(self.request("/top?n=-1")[0], 400)
+        self.assertEqual(self.request("/top?n=1")[0], 200)
+
+    def test_parallel_queries_and_uploads(self):
+        job_type_id = self.list_job_id[0]
+        total = self.request("/summary")[1]["finish_count"]
+        list_status = []
+
+        def upload(loop: int):
+            for _ in range(5):
+                list_status.append(self.request("/jobs", {"employee": "员工%d" % (loop % 3), "employee_id": loop % 3,
+                                                          "jobs": [[job_type_id, 1, 1]]})[0])
+
+        def query():
+            for _ in range(5):
+                list_status.append(self.request("/summary?group_by=employee")[0])
+
+        list_thread = [threading.Thread(target=upload if loop % 2 else query, args=(loop, ) if loop % 2 else ())
+                       for loop in range(8)]
+        for thread in list_thread:
+            thread.start()
+        for thread in list_thread:
+            thread.join()
+        self.assertEqual(list_status, [200] * 40)
+        self.assertEqual(self.request("/summary")[1]["finish_count"], total + 20)
+        pd.testing.assert_frame_equal(self.company.calc_salary_matrix(), fresh_copy(self.company).calc_salary_matrix(),
+                                      check_exact=True)
+
+
+if __name__ == '__main__':
+    unittest.main()